@@ -0,0 +1,16 @@
+"""
+Benchmarks for tld.py
+
+Each benchmark is a small script that can be run from the repository root as a
+module, for example
+
+    $ python -m benchmarks.bench_prefixes
+
+The suite of benchmarks in bench_suite, which times the main operations of tld
+and can save and compare results as JSON, is run by
+
+    $ python -m benchmarks
+
+These are not part of the test suite. They exist to keep track of how tld
+scales as lists grow.
+"""
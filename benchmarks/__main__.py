@@ -0,0 +1,6 @@
+"""
+Run the benchmark suite, as described in benchmarks.bench_suite.
+"""
+from benchmarks.bench_suite import main
+
+main()
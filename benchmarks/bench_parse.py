@@ -0,0 +1,102 @@
+"""
+Measure the throughput of the taskline parser in tld.py.
+
+To run, call
+
+    $ python -m benchmarks.bench_parse [SIZE ...]
+
+Each SIZE is a number of lines in a synthetic task file. For each size this
+times the single-pass parser used by TaskDict against the original
+line-by-line parser, and reports lines parsed per second.
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+from tld import TaskDict, _hash, _iter_tasks, _tasklines_from_tasks
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+
+def line_by_line(content):
+    """
+    The original parsing loop of TaskDict.__init__, kept for comparison.
+    """
+    tasks = {}
+    tasklines = [taskline.strip() for taskline in content.splitlines(True)
+                 if taskline]
+    for taskline in tasklines:
+        if '|' in taskline:
+            text, _, meta = taskline.rpartition('|')
+            task = {'text': text.strip()}
+            for piece in meta.strip().split(';'):
+                key, value = piece.split(':')
+                task[key.strip()] = value.strip()
+        else:
+            text = taskline.strip()
+            task = {'text': text, 'id': _hash(text)}
+        tasks[task['id']] = task
+    return tasks
+
+
+def single_pass(content):
+    """
+    Parse content with the parser used by TaskDict.
+    """
+    return {task['id']: task for task in _iter_tasks(content)}
+
+
+def as_strings(tasks):
+    """
+    Return tasks as plain dictionaries of strings, for comparing parsers.
+    """
+    return {id_: {key: str(value) for key, value in task.items()}
+            for id_, task in tasks.items()}
+
+
+def synthetic_content(size):
+    """
+    Return the text of a task file with `size` tasks, some with tags and dates.
+    """
+    tasks = []
+    for i in range(size):
+        text = "synthetic task number {} with some words".format(i)
+        task = {'id': _hash(text), 'text': text}
+        if i % 3 == 0:
+            task['tags'] = 'work,project{}'.format(i % 17)
+        if i % 5 == 0:
+            task['date'] = '2026-{:02d}-{:02d}'.format(i % 12 + 1, i % 28 + 1)
+        tasks.append(task)
+    return ''.join(_tasklines_from_tasks(tasks))
+
+
+def best_time(func, repeat=3):
+    """
+    Return the best wall time in seconds of `repeat` calls to func.
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main(sizes=DEFAULT_SIZES):
+    """
+    Time both parsers, and a full TaskDict load, on each size.
+    """
+    print("{:>9}  {:>14}  {:>14}  {:>14}".format(
+        "lines", "single (l/s)", "by line (l/s)", "TaskDict (s)"))
+    with tempfile.TemporaryDirectory() as taskdir:
+        for size in sizes:
+            content = synthetic_content(size)
+            assert as_strings(single_pass(content)) == line_by_line(content)
+            with open(os.path.join(taskdir, 'tasks'), 'w') as tfile:
+                tfile.write(content)
+            repeat = 3 if size < 1000000 else 1
+            fast = best_time(lambda c=content: single_pass(c), repeat)
+            slow = best_time(lambda c=content: line_by_line(c), repeat)
+            load = best_time(lambda: TaskDict(taskdir=taskdir), repeat)
+            print("{:>9}  {:14.0f}  {:14.0f}  {:14.4f}".format(
+                size, size / fast, size / slow, load))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,71 @@
+"""
+Compare the prefix engine in tld.py with the original quadratic version.
+
+To run, call
+
+    $ python -m benchmarks.bench_prefixes [SIZE ...]
+
+Each SIZE is a number of synthetic task ids. The quadratic reference is skipped
+for sizes where it would take too long to be useful.
+"""
+import sys
+import timeit
+
+from tld import _hash, _prefixes
+
+DEFAULT_SIZES = (100, 1000, 5000, 50000)
+QUADRATIC_LIMIT = 5000
+
+
+def quadratic_prefixes(ids, minsize=0):
+    """
+    The original implementation of tld._prefixes, kept for comparison.
+    """
+    prefixes = {}
+    for id_ in ids:
+        others = set(ids).difference([id_])
+        found = False
+        for i in range(minsize + 1, len(id_)+1):
+            prefix = id_[:i]
+            if not any(map(lambda other, pf=prefix: other.startswith(pf), others)):
+                prefixes[id_] = prefix
+                found = True
+                break
+        if not found:
+            raise KeyError("Unresolvable hash collision occurred.")
+    return prefixes
+
+
+def synthetic_ids(size):
+    """
+    Return `size` task ids hashed from distinct synthetic task texts.
+    """
+    return [_hash("synthetic task {}".format(i)) for i in range(size)]
+
+
+def best_time(func, repeat=3):
+    """
+    Return the best wall time in seconds of `repeat` calls to func.
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main(sizes=DEFAULT_SIZES):
+    """
+    Time both implementations on each size and print a table.
+    """
+    print("{:>8}  {:>12}  {:>12}".format("ids", "sorted (s)", "quadratic (s)"))
+    for size in sizes:
+        ids = synthetic_ids(size)
+        fast = best_time(lambda ids=ids: _prefixes(ids))
+        if size <= QUADRATIC_LIMIT:
+            assert quadratic_prefixes(ids) == _prefixes(ids)
+            slow = "{:12.4f}".format(best_time(
+                lambda ids=ids: quadratic_prefixes(ids), repeat=1))
+        else:
+            slow = "{:>12}".format("skipped")
+        print("{:>8}  {:12.4f}  {}".format(size, fast, slow))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
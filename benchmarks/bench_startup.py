@@ -0,0 +1,114 @@
+"""
+Measure how long tld takes to start.
+
+To run, call
+
+    $ python -m benchmarks.bench_startup [--runs N] [--max-ms MS]
+
+This runs tld in fresh interpreters to list a small task file, to add a task,
+and to list with an option (which builds the argument parser). For each it
+reports the median wall time, and the import time of tld as measured by
+`python -X importtime`.
+
+Listing and adding are meant to avoid importing the heavier modules, which are
+deferred until they are needed. If one of these is imported anyway, or a
+median time exceeds --max-ms, the benchmark exits with status 1, so that it
+can be used to catch startup regressions.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from tld import _hash
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Name, arguments to tld, and modules which must not be imported.
+SCENARIOS = (
+    ('list', [], ('argparse', 're', 'hashlib', 'datetime')),
+    ('add', ['Buy', 'milk.'], ('argparse', 're', 'datetime')),
+    ('list --grep', ['--grep', 'task'], ()),
+)
+
+RUN_TLD = "import sys, tld; tld.main(sys.argv[1:])"
+
+
+def run_tld(taskdir, args, importtime=False):
+    """
+    Run tld with args in a fresh interpreter in taskdir, and return its
+    stderr.
+    """
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', RUN_TLD] + args
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    env.pop('TLD_SOCKET', None)
+    result = subprocess.run(command, cwd=taskdir, env=env, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    return result.stderr
+
+
+def imported_modules(stderr):
+    """
+    Return {module: (self us, cumulative us)} from `-X importtime` output.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        modules[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+    return modules
+
+
+def median_ms(taskdir, args, runs):
+    """
+    Return the median wall time in milliseconds of `runs` runs of tld.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_tld(taskdir, args)
+        times.append(1000 * (time.perf_counter() - start))
+    return statistics.median(times)
+
+
+def main(argv=None):
+    """
+    Time each scenario, and return 1 if any of them regressed.
+    """
+    parser = argparse.ArgumentParser(description="Measure tld startup.")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-ms', type=float, default=None)
+    options = parser.parse_args(argv)
+    failed = False
+    print("{:<12}  {:>10}  {:>12}  {}".format(
+        "scenario", "median ms", "import tld ms", "unexpected imports"))
+    with tempfile.TemporaryDirectory() as taskdir:
+        with open(os.path.join(taskdir, 'tasks'), 'w') as tfile:
+            tfile.write("".join(
+                "task {0} | id:{1}\n".format(i, _hash("task {}".format(i)))
+                for i in range(100)))
+        for name, args, forbidden in SCENARIOS:
+            wall = median_ms(taskdir, args, options.runs)
+            modules = imported_modules(run_tld(taskdir, args,
+                                               importtime=True))
+            unexpected = sorted(set(forbidden) & set(modules))
+            tld_ms = modules.get('tld', (0, 0))[1] / 1000
+            print("{:<12}  {:10.1f}  {:12.1f}  {}".format(
+                name, wall, tld_ms, ', '.join(unexpected) or '-'))
+            if unexpected:
+                failed = True
+            if options.max_ms is not None and wall > options.max_ms:
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
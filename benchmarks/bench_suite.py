@@ -0,0 +1,182 @@
+"""
+Time the hot paths of tld.py on synthetic lists of several sizes.
+
+To run, call
+
+    $ python -m benchmarks [--sizes SIZE ...] [--output FILE] [--compare FILE]
+
+(or `python -m benchmarks.bench_suite` with the same options). For each size,
+a task file with that many lines is generated, and each operation below is
+timed, keeping the best of --repeat runs:
+
+    init        TaskDict.__init__ reading the file
+    prefixes    _prefixes of all ids
+    getitem     TaskDict.__getitem__ of LOOKUPS prefixes
+    print_list  TaskDict.print_list of the whole list
+    write       TaskDict.write after removing a task (a full rewrite)
+    append      TaskDict.write after adding a task
+    main        main() listing the file, end to end
+
+The results are printed, and written as JSON to --output. Given the JSON of an
+earlier run with --compare, each time is also shown as a ratio to the earlier
+one, so that results can be compared between commits.
+"""
+import argparse
+import contextlib
+import json
+import operator
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import timeit
+
+from tld import TaskDict, _prefixes, _tasklines_from_tasks, main as tld_main
+from benchmarks.bench_parse import synthetic_content
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+OPERATIONS = ('init', 'prefixes', 'getitem', 'print_list', 'write', 'append',
+              'main')
+
+# Number of prefixes looked up by the getitem benchmark.
+LOOKUPS = 1000
+
+
+def measure(func, setup=None, repeat=3):
+    """
+    Return the best wall time in seconds of `repeat` calls to func, each after
+    an untimed call to setup.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        elapsed = timeit.timeit(func, number=1)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_size(taskdir, size, repeat):
+    """
+    Return {operation: seconds} for a synthetic list of `size` lines.
+    """
+    path = os.path.join(taskdir, 'tasks')
+    content = synthetic_content(size)
+
+    def reset():
+        with open(path, 'w') as tfile:
+            tfile.write(content)
+
+    # Files written by tld are sorted by id, so time those.
+    reset()
+    taskdict = TaskDict(taskdir=taskdir)
+    content = ''.join(_tasklines_from_tasks(
+        sorted(taskdict.tasks.values(), key=operator.attrgetter('id'))))
+    reset()
+    ids = list(taskdict.tasks)
+    prefixes = list(_prefixes(ids).values())
+    lookups = random.Random(size).choices(prefixes, k=LOOKUPS)
+    loaded = []
+
+    def load():
+        reset()
+        loaded[:] = [TaskDict(taskdir=taskdir)]
+
+    def remove_and_write():
+        loaded[0].remove_task(lookups[0])
+        loaded[0].write()
+
+    def add_and_write():
+        loaded[0].add_task("one more synthetic task")
+        loaded[0].write()
+
+    results = {}
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            results['init'] = measure(lambda: TaskDict(taskdir=taskdir),
+                                      repeat=repeat)
+            results['prefixes'] = measure(lambda: _prefixes(ids),
+                                          repeat=repeat)
+            results['getitem'] = measure(
+                lambda: [taskdict[prefix] for prefix in lookups],
+                repeat=repeat)
+            results['print_list'] = measure(taskdict.print_list,
+                                            repeat=repeat)
+            results['write'] = measure(remove_and_write, load, repeat)
+            results['append'] = measure(add_and_write, load, repeat)
+            reset()
+            results['main'] = measure(
+                lambda: tld_main(['--task-dir', taskdir]), repeat=repeat)
+    return results
+
+
+def git_revision():
+    """
+    Return the current git commit, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    """
+    Print a table of results, with ratios to baseline if it is given.
+    """
+    print("{:>9}  {:<10}  {:>12}  {}".format(
+        "lines", "operation", "seconds",
+        "vs baseline" if baseline else "").rstrip())
+    for size, times in results.items():
+        for operation in OPERATIONS:
+            line = "{:>9}  {:<10}  {:12.6f}".format(size, operation,
+                                                   times[operation])
+            old = (baseline or {}).get(size, {}).get(operation)
+            if old:
+                line += "  {:10.2f}x".format(times[operation] / old)
+            print(line)
+
+
+def main(argv=None):
+    """
+    Run the suite and report the results.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark tld.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        metavar='SIZE', help="numbers of lines to time")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each operation (default: 3)")
+    parser.add_argument('--output', metavar='FILE',
+                        help="write the results as JSON to FILE")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare with the JSON results in FILE")
+    options = parser.parse_args(argv)
+    results = {}
+    with tempfile.TemporaryDirectory() as taskdir:
+        for size in options.sizes:
+            repeat = options.repeat if size < 1000000 else 1
+            results[str(size)] = time_size(taskdir, size, repeat)
+    baseline = None
+    if options.compare:
+        with open(options.compare, 'r') as bfile:
+            baseline = json.load(bfile)['results']
+    print_results(results, baseline)
+    if options.output:
+        report = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }
+        with open(options.output, 'w') as ofile:
+            json.dump(report, ofile, indent=2, sort_keys=True)
+            ofile.write('\n')
+
+
+if __name__ == "__main__":
+    main()
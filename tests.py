@@ -21,13 +21,23 @@ under the MIT License (https://opensource.org/licenses/MIT).
 
 For more information, see tld.py or https://github.com/davidlowryduda/tld.
 """
+import asyncio
 import contextlib
 import datetime
+import json
+import marshal
+import pstats
+import tempfile
+import threading
+import time
 import unittest
 import os
 from io import StringIO
+from unittest import mock
 
-from tld import TaskDict, _build_parser, main
+from tld import (AsyncTaskDict, Task, TaskDict, TaskDirectory,
+                 _build_parser, _compile_query, _make_server, _parse_args,
+                 _prefixes, main, task_lock)
 
 TASK1_ID = '3fa2e7254e7ce263b186a7ab33dbc492f4138f6d'
 TASK2_ID = '3ea913db45595a91c19c50ce6f977444fa69e82a'
@@ -107,15 +117,17 @@ class BasicTaskStructure(unittest.TestCase):
         """
         Test that one can edit tasks.
 
-        Note that the original ID as a key doesn't change, even though the
-        embedded subID does. This is corrected on next read.
+        The edited task is moved to its new ID, so its new prefix finds it.
         """
         self.taskdict.edit_task('3f', "test task 3")
         goal = {
             TASK2_ID: {'id': TASK2_ID, 'text': "test task 2"},
-            TASK1_ID: {'id': TASK3_ID, 'text': "test task 3"},
+            TASK3_ID: {'id': TASK3_ID, 'text': "test task 3"},
         }
         self.assertEqual(self.taskdict.tasks, goal)
+        self.assertEqual(self.taskdict['4']['text'], "test task 3")
+        with self.assertRaises(KeyError):
+            self.taskdict['3f']
         return
 
     def test_tag(self):
@@ -152,18 +164,81 @@ class BasicTaskStructure(unittest.TestCase):
     def test_sub_replace_edit(self):
         """
         Test that one can edit tasks through `s/old/new` notation.
-
-        Note that the original ID as a key doesn't change, even through the
-        embedded subID does. This is corrected on next read.
         """
         self.taskdict.edit_task('3f', "s/1/3")
         goal = {
             TASK2_ID: {'id': TASK2_ID, 'text': "test task 2"},
-            TASK1_ID: {'id': TASK3_ID, 'text': "test task 3"},
+            TASK3_ID: {'id': TASK3_ID, 'text': "test task 3"},
         }
         self.assertEqual(self.taskdict.tasks, goal)
         return
 
+    def test_prefix_lookup(self):
+        """
+        Test that tasks are found by prefix, and that unknown or ambiguous
+        prefixes raise.
+        """
+        self.assertEqual(self.taskdict['3e']['text'], "test task 2")
+        with self.assertRaises(KeyError):
+            self.taskdict['5']
+        with self.assertRaises(IOError):
+            self.taskdict['3']
+
+    def test_finish_after_edit(self):
+        """
+        Test that an edited task is finished by its new prefix.
+        """
+        self.taskdict.edit_task('3f', "test task 3")
+        self.taskdict.finish_task('4')
+        task_goal = {TASK2_ID: {'id': TASK2_ID, 'text': "test task 2"}}
+        done_goal = {TASK3_ID: {'id': TASK3_ID, 'text': "test task 3"}}
+        self.assertEqual(self.taskdict.tasks, task_goal)
+        self.assertEqual(self.taskdict.done, done_goal)
+
+    def test_batch(self):
+        """
+        Test that a batch resolves every prefix against the tasks as they were
+        before the batch, and reports failures without stopping.
+        """
+        batch = [
+            "test task 3\n",
+            "-f 3e\n",
+            "-f 3\n",
+            "\n",
+            "-r 3f\n",
+        ]
+        report = self.taskdict.run_batch(batch)
+        self.assertEqual(report, [
+            "1: added 417af60 - test task 3\n",
+            "2: finished 3ea913d - test task 2\n",
+            "3: error: Ambiguous prefix: 3.\n",
+            "5: removed 3fa2e72 - test task 1\n",
+            "3 applied, 1 failed\n",
+        ])
+        self.assertEqual(self.taskdict.tasks,
+                         {TASK3_ID: {'id': TASK3_ID, 'text': "test task 3"}})
+        self.assertEqual(self.taskdict.done,
+                         {TASK2_ID: {'id': TASK2_ID, 'text': "test task 2"}})
+        return
+
+    def test_batch_edit(self):
+        """
+        Test that an edit in a batch is reported as applied, and that later
+        lines still find the task by its original prefix.
+        """
+        report = self.taskdict.run_batch(["-e 3f test task 3\n",
+                                          "-e 3f s/3/4\n",
+                                          "-f 3f\n"])
+        self.assertEqual(report, [
+            "1: edited 417af60 - test task 3\n",
+            "2: edited 84328fb - test task 4\n",
+            "3: finished 84328fb - test task 4\n",
+            "3 applied, 0 failed\n",
+        ])
+        self.assertEqual(self.taskdict.done,
+                         {TASK4_ID: {'id': TASK4_ID, 'text': "test task 4"}})
+        return
+
     def test_print(self):
         """
         Test basic print functionality.
@@ -230,6 +305,170 @@ class BasicTaskStructure(unittest.TestCase):
         self.assertEqual(tmp_stdout.getvalue(), goal)
         return
 
+    def test_grep_keeps_unique_prefixes(self):
+        """
+        Test that prefixes of filtered tasks are unique in the full list.
+        """
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(grep_string='1')
+        self.assertEqual(tmp_stdout.getvalue(), "3f - test task 1\n")
+        return
+
+    def test_grep_several_terms(self):
+        """
+        Test that several grep terms must all match, or any with match_any.
+        """
+        self.taskdict.add_task("test task 3", tags=['two'])
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(grep_string=['TASK', 'two'])
+        self.assertEqual(tmp_stdout.getvalue(), "4 - test task 3\n")
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(grep_string=['1', '2'], match_any=True)
+        self.assertEqual(tmp_stdout.getvalue(),
+                         "3e - test task 2\n3f - test task 1\n")
+        return
+
+    def test_grep_regex(self):
+        """
+        Test that grep terms can be regular expressions.
+        """
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(grep_string=r'task [2-9]$', regex=True)
+        self.assertEqual(tmp_stdout.getvalue(), "3e - test task 2\n")
+        return
+
+    def test_tag_filter(self):
+        """
+        Test that tag filters match whole tags only.
+        """
+        self.taskdict.add_task("test task 3", tags=['foobar'])
+        self.taskdict.add_task("test task 4", tags=['Foo', 'bar'])
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(tag_filter=['foo'])
+        self.assertEqual(tmp_stdout.getvalue(), "8 - test task 4\n")
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(tag_filter=['foo', 'foobar'],
+                                     match_any=True)
+        self.assertEqual(tmp_stdout.getvalue(),
+                         "4 - test task 3\n8 - test task 4\n")
+        return
+
+    def test_word_filter(self):
+        """
+        Test that word filters match whole words, and see later changes.
+        """
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(words=['Task 1'])
+        self.assertEqual(tmp_stdout.getvalue(), "3f - test task 1\n")
+        self.taskdict.add_task("test task 12")
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(words=['12'], grep_string='test')
+        self.assertEqual(tmp_stdout.getvalue(), "9 - test task 12\n")
+        return
+
+    def test_sort_and_page(self):
+        """
+        Test listing a page of tasks in another order. The prefix column fits
+        the page, but prefixes stay unique in the whole list.
+        """
+        self.taskdict.add_task("b task 3", tags=['zeta'])
+        self.taskdict.add_task("a task 4", tags=['alpha'])
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(sort='text', limit=2, offset=1)
+        self.assertEqual(tmp_stdout.getvalue(),
+                         "d  - b task 3\n3f - test task 1\n")
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(sort='tag', limit=1)
+        self.assertEqual(tmp_stdout.getvalue(), "7 - a task 4\n")
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(grep_string='test', offset=1)
+        self.assertEqual(tmp_stdout.getvalue(), "3f - test task 1\n")
+        return
+
+    def test_query(self):
+        """
+        Test listing the tasks matching a query.
+        """
+        self.taskdict.add_task("draft task 3", tags=['work'])
+        self.taskdict.add_task("test task 4", tags=['Work', 'home'])
+        self.taskdict.tasks[TASK2_ID]['date'] = '2026-01-02'
+        self.taskdict['4']['date'] = '2026-03-01'
+        self.taskdict['8']['date'] = '2025-12-31'
+        goals = (
+            ("tag:work", "4 - draft task 3\n8 - test task 4\n"),
+            ("tag:work and date>=2026-01-01", "4 - draft task 3\n"),
+            ("tag:work and date>=2026-01-01 and not text~/draft/", ""),
+            ("date<2026-03-01 and (tag:home or task 2)",
+             "3e - test task 2\n8  - test task 4\n"),
+            ('not text:"TASK 1" and not tag:work', "3e - test task 2\n"),
+            ("date=2026-01-02 or id:3f",
+             "3e - test task 2\n3f - test task 1\n"),
+        )
+        for query, goal in goals:
+            tmp_stdout = StringIO()
+            with contextlib.redirect_stdout(tmp_stdout):
+                self.taskdict.print_list(query=query)
+            self.assertEqual(tmp_stdout.getvalue(), goal, query)
+        return
+
+    def test_query_index(self):
+        """
+        Test that tag and date terms are looked up in the index, and that
+        badly formed queries are refused.
+        """
+        self.taskdict.add_task("test task 3", tags=['work'])
+        self.taskdict.tasks[TASK2_ID]['date'] = '2026-01-02'
+        self.taskdict.tasks[TASK1_ID]['date'] = '2025-01-02'
+        index = self.taskdict._term_index('tasks')
+        query = _compile_query("date>2025-06-01 or tag:work and text~x")
+        self.assertTrue(query.indexed)
+        self.assertEqual(query.lookup(index),
+                         {TASK2_ID, self.taskdict['4']['id']})
+        self.assertFalse(_compile_query("tag:work or text:x").indexed)
+        for query in ("", "tag:work and", "(tag:work", "date<soon",
+                      "text~/(/", "size:3", "text:a)"):
+            with self.assertRaises(ValueError):
+                _compile_query(query)
+        return
+
+    def test_output_formats(self):
+        """
+        Test that each machine readable format gives every field of a task.
+        """
+        self.taskdict.add_task("test\ttask, \"3\"", tags=['a', 'b'])
+        self.taskdict.tasks[TASK2_ID]['date'] = '2026-01-02'
+        lines = list(self.taskdict.iter_list(output_format='jsonl'))
+        self.assertEqual(json.loads(lines[0]), {
+            'id': TASK2_ID, 'prefix': '3e', 'text': "test task 2",
+            'tags': [], 'date': '2026-01-02',
+        })
+        self.assertEqual(json.loads(lines[2])['tags'], ['a', 'b'])
+        lines = list(self.taskdict.iter_list(output_format='tsv'))
+        self.assertEqual(lines[0], "id\tprefix\ttext\ttags\tdate\n")
+        self.assertEqual(lines[1].split('\t')[1:],
+                         ['3e', "test task 2", '', '2026-01-02\n'])
+        self.assertEqual(lines[3].split('\t')[2:],
+                         ['test\\ttask, "3"', 'a,b', '\n'])
+        lines = list(self.taskdict.iter_list(output_format='csv',
+                                             grep_string='3'))
+        self.assertEqual(lines, [
+            "id,prefix,text,tags,date\n",
+            '{},4,"test\ttask, ""3""","a,b",\n'.format(
+                self.taskdict['4']['id']),
+        ])
+        return
+
     def test_print_with_tags(self):
         """
         Test that tags are printed when showtags=True.
@@ -246,6 +485,64 @@ class BasicTaskStructure(unittest.TestCase):
         self.assertEqual(tmp_stdout.getvalue(), goal)
         return
 
+    def test_print_with_dates(self):
+        """
+        Test that dates of newly added tasks are printed when showdates=True.
+        """
+        tmp_stdout = StringIO()
+        self.taskdict.add_task("test task 3", dated=True)
+        today = str(datetime.date.today())
+        blank = ' ' * len(today)
+        goal = (
+            f"{blank} | 3e - test task 2\n"
+            f"{blank} | 3f - test task 1\n"
+            f"{today} | 4  - test task 3\n"
+        )
+        with contextlib.redirect_stdout(tmp_stdout):
+            self.taskdict.print_list(showdates=True)
+        self.assertEqual(tmp_stdout.getvalue(), goal)
+        return
+
+    def test_print_to_closed_pipe(self):
+        """
+        Test that printing stops quietly when stdout is a closed pipe.
+        """
+        class ClosedPipe(StringIO):
+            "A stdout whose reader has gone away."
+            def write(self, _):
+                raise BrokenPipeError
+
+        with contextlib.redirect_stdout(ClosedPipe()):
+            self.taskdict.print_list()
+        return
+
+
+class PrefixTests(unittest.TestCase):
+    """
+    A set of tests for the computation of shortest unique prefixes.
+    """
+    def test_shortest_prefixes(self):
+        """
+        Test that each prefix is the shortest one not shared by another id.
+        """
+        ids = ['abc1', 'abd2', 'b123', 'abc2x']
+        goal = {'abc1': 'abc1', 'abd2': 'abd', 'b123': 'b', 'abc2x': 'abc2'}
+        self.assertEqual(_prefixes(ids), goal)
+
+    def test_minsize(self):
+        """
+        Test that prefixes are at least minsize + 1 characters long.
+        """
+        goal = {TASK1_ID: TASK1_ID[:7], TASK2_ID: TASK2_ID[:7]}
+        self.assertEqual(_prefixes([TASK1_ID, TASK2_ID], minsize=6), goal)
+
+    def test_collision(self):
+        """
+        Test that an id which is a prefix of another id cannot be resolved.
+        """
+        with self.assertRaises(KeyError):
+            _prefixes(['abc', 'abcd'])
+
 
 class IOTests(unittest.TestCase):
     """
@@ -326,6 +623,187 @@ class IOTests(unittest.TestCase):
         }
         self.assertEqual(taskdict.tasks, goal)
 
+    def test_append_new_tasks(self):
+        """
+        Check that tasks added to a large sorted file are appended to it, and
+        that the untouched done file is not created.
+        """
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        for i in range(20):
+            taskdict.add_task("task {}".format(i))
+        taskdict.write()
+
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        taskdict.add_task("test task 1")
+        taskdict.write()
+        with open('tests/task_test', 'r') as test_file:
+            lines = test_file.readlines()
+        self.assertEqual(len(lines), 21)
+        self.assertEqual(lines[-1].strip(), f"test task 1 | id:{TASK1_ID}")
+        self.assertFalse(os.path.exists('tests/.task_test.done'))
+        return
+
+    def test_compact_on_remove(self):
+        """
+        Check that removing a task rewrites the file in sorted order.
+        """
+        line1 = f"test task 1 | id:{TASK1_ID}"
+        line2 = f"test task 2 | id:{TASK2_ID}"
+        line3 = f"test task 3 | id:{TASK3_ID}"
+        with open('tests/task_test', 'w') as test_file:
+            test_file.write(line3 + '\n' + line1 + '\n' + line2)
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        taskdict.remove_task('41')
+        taskdict.write()
+        with open('tests/task_test', 'r') as test_file:
+            lines = [line.strip() for line in test_file]
+        self.assertEqual(lines, [line2, line1])
+        return
+
+    def test_finish_without_reading_done(self):
+        """
+        Check that finishing a task appends to the done file without reading
+        it, and that the done list is read on first access.
+        """
+        with open('tests/task_test', 'w') as test_file:
+            test_file.write(f"test task 1 | id:{TASK1_ID}\n")
+        with open('tests/.task_test.done', 'w') as test_file:
+            test_file.write(f"test task 2 | id:{TASK2_ID}\n")
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        taskdict.finish_task('3f')
+        taskdict.write()
+        self.assertIsNone(taskdict._done)
+        with open('tests/.task_test.done', 'r') as test_file:
+            lines = [line.strip() for line in test_file]
+        self.assertEqual(lines, [f"test task 2 | id:{TASK2_ID}",
+                                 f"test task 1 | id:{TASK1_ID}"])
+        goal = {
+            TASK1_ID: {'id': TASK1_ID, 'text': "test task 1"},
+            TASK2_ID: {'id': TASK2_ID, 'text': "test task 2"},
+        }
+        self.assertEqual(taskdict.done, goal)
+        return
+
+    def test_list_done_without_reading(self):
+        """
+        Check that done tasks are listed, grepped and found by prefix through
+        a view of the done file, together with tasks finished since.
+        """
+        with open('tests/task_test', 'w') as test_file:
+            test_file.write(f"test task 1 | id:{TASK1_ID}\n")
+        with open('tests/.task_test.done', 'w') as test_file:
+            test_file.write(f"test task 2 | id:{TASK2_ID}; tags:Big\n\n"
+                            f"test | task 3 | id:{TASK3_ID}\n")
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        taskdict.finish_task('3f')
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            taskdict.print_list(kind='done')
+            taskdict.print_list(kind='done', grep_string=['big', 'TASK 1'],
+                                match_any=True)
+            taskdict.print_list(kind='done', grep_string=r'\|', regex=True)
+        self.assertEqual(tmp_stdout.getvalue(), (
+            "3e - test task 2\n"
+            "3f - test task 1\n"
+            "4  - test | task 3\n"
+            "3e - test task 2\n"
+            "3f - test task 1\n"
+            "4 - test | task 3\n"
+        ))
+        self.assertEqual(taskdict.find_done('4')['text'], "test | task 3")
+        with self.assertRaises(KeyError):
+            taskdict.find_done('5')
+        with self.assertRaises(IOError):
+            taskdict.find_done('3')
+        self.assertIsNone(taskdict._done)
+        return
+
+    def test_list_done_with_other_id_keys(self):
+        """
+        Check that keys ending in 'id' are not taken for the id of a done
+        task.
+        """
+        with open('tests/.task_test.done', 'w') as test_file:
+            test_file.write(f"weird | x-id:zzz; id:{TASK1_ID}\n"
+                            f"odd | id:{TASK2_ID}; x-id:yyy\n")
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            taskdict.print_list(kind='done')
+        self.assertEqual(tmp_stdout.getvalue(), "3e - odd\n3f - weird\n")
+        self.assertEqual(taskdict.find_done('3f')['x-id'], "zzz")
+        self.assertIsNone(taskdict._done)
+        return
+
+    def test_list_done_with_anchored_regex(self):
+        """
+        Check that anchored regular expressions match done tasks as they
+        match the active list.
+        """
+        with open('tests/.task_test.done', 'w') as test_file:
+            test_file.write(f"buy milk | id:{TASK1_ID}\n"
+                            f"buy more milk | id:{TASK2_ID}\n")
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        goal = "3e - buy more milk\n3f - buy milk\n"
+        for pattern in ('^buy', 'milk$'):
+            tmp_stdout = StringIO()
+            with contextlib.redirect_stdout(tmp_stdout):
+                taskdict.print_list(kind='done', grep_string=pattern,
+                                    regex=True)
+            self.assertEqual(tmp_stdout.getvalue(), goal, pattern)
+        return
+
+    def test_list_done_with_plain_lines(self):
+        """
+        Check that a done file with lines without ids is still listed.
+        """
+        with open('tests/.task_test.done', 'w') as test_file:
+            test_file.write(f"test task 1 | id:{TASK1_ID}\ntest task 2\n")
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            taskdict.print_list(kind='done')
+        self.assertEqual(tmp_stdout.getvalue(),
+                         "3e - test task 2\n3f - test task 1\n")
+        return
+
+    def test_read_metadata_with_colons(self):
+        """
+        Check that metadata values may contain ':', that lines without an id
+        are hashed, and that blank lines are skipped.
+        """
+        line1 = f"test task 1 | id:{TASK1_ID}; due:12:30"
+        line2 = "test task 2 | tags:two"
+        with open('tests/task_test', 'w') as test_file:
+            test_file.write(line1 + '\n\n' + line2 + '\n')
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        goal = {
+            TASK1_ID: {'id': TASK1_ID, 'text': "test task 1", 'due': "12:30"},
+            TASK2_ID: {'id': TASK2_ID, 'text': "test task 2", 'tags': "two"},
+        }
+        self.assertEqual(taskdict.tasks, goal)
+        return
+
+    def test_round_trip(self):
+        """
+        Check that reading and writing a task file leaves it unchanged.
+        """
+        lines = [
+            f"test task 2 | id:{TASK2_ID}; tags:a, b; date:2018-06-01\n",
+            f"test task 1 | id:{TASK1_ID}; date:someday; due:12:30\n",
+        ]
+        with open('tests/task_test', 'w') as test_file:
+            test_file.writelines(lines)
+        taskdict = TaskDict(taskdir='tests', name='task_test')
+        self.assertEqual(taskdict['3e'].date, datetime.date(2018, 6, 1))
+        self.assertEqual(taskdict['3e'].tags, ('a', ' b'))
+        taskdict.add_task("test task 3")
+        taskdict.remove_task('41')
+        taskdict.write()
+        with open('tests/task_test', 'r') as test_file:
+            self.assertEqual(test_file.readlines(), lines)
+        return
+
     def tearDown(self):
         if os.path.exists('tests/task_test'):
             os.remove('tests/task_test')
@@ -335,6 +813,778 @@ class IOTests(unittest.TestCase):
             os.rmdir('tests')
 
 
+class IdSchemeTests(unittest.TestCase):
+    """
+    A set of tests for the id schemes of new tasks.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+        self.path = os.path.join(self.taskdir, 'task_test')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_id_lengths(self):
+        """
+        Check the form of the ids of each scheme.
+        """
+        for scheme, length in (('sha1', 40), ('blake2b', 20), ('short', 16)):
+            taskdict = TaskDict(taskdir=self.taskdir, name='task_test',
+                                id_scheme=scheme)
+            taskdict.add_task("test task 1")
+            id_, = taskdict.tasks
+            self.assertEqual(len(id_), length)
+            self.assertTrue(set(id_) <= set('0123456789abcdef'))
+        return
+
+    def test_existing_ids_are_kept(self):
+        """
+        Check that a list written with SHA1 ids can be used with another
+        scheme, and that lines without ids get ids in the new scheme.
+        """
+        with open(self.path, 'w') as test_file:
+            test_file.write("test task 1 | id:{}\ntest task 2\n".format(
+                TASK1_ID))
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test',
+                            id_scheme='short')
+        self.assertEqual(taskdict['3f']['text'], "test task 1")
+        taskdict.add_task("test task 3")
+        self.assertEqual(sorted(len(id_) for id_ in taskdict.tasks),
+                         [16, 16, 40])
+        taskdict.finish_task('3f')
+        taskdict.write()
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        self.assertEqual([len(id_) for id_ in taskdict.tasks], [16, 16])
+        self.assertEqual(list(taskdict.done), [TASK1_ID])
+        return
+
+
+class TaskTests(unittest.TestCase):
+    """
+    A set of tests for the dictionary behavior of a single task.
+    """
+    def test_mapping(self):
+        """
+        Test that a task reads and writes like a dictionary of its metadata.
+        """
+        task = Task(TASK1_ID, "test task 1")
+        task['tags'] = "one,two"
+        task['date'] = "2018-06-01"
+        task['due'] = "12:30"
+        self.assertEqual(task.tags, ('one', 'two'))
+        self.assertEqual(task.date, datetime.date(2018, 6, 1))
+        self.assertEqual(task, {'id': TASK1_ID, 'text': "test task 1",
+                                'tags': "one,two",
+                                'date': datetime.date(2018, 6, 1),
+                                'due': "12:30"})
+        del task['tags']
+        self.assertNotIn('tags', task)
+        self.assertEqual(task.get('tags', ''), '')
+        return
+
+
+class CacheTests(unittest.TestCase):
+    """
+    A set of tests for the sidecar index kept next to task files.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+        self.path = os.path.join(self.taskdir, 'task_test')
+        self.cache_path = os.path.join(self.taskdir, '.task_test.idx')
+        with open(self.path, 'w') as test_file:
+            test_file.write("test task 1\ntest task 2\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_index_is_used(self):
+        """
+        Check that an index is written on first read and used afterwards.
+        """
+        TaskDict(taskdir=self.taskdir, name='task_test', cache=True)
+        with open(self.cache_path, 'rb') as cfile:
+            record = marshal.load(cfile)
+        record['tasks'] = [(id_, text.upper(), tags, date, extra)
+                           for id_, text, tags, date, extra in record['tasks']]
+        with open(self.cache_path, 'wb') as cfile:
+            marshal.dump(record, cfile)
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test', cache=True)
+        self.assertEqual(taskdict['3f']['text'], "TEST TASK 1")
+        return
+
+    def test_edit_task_with_cache(self):
+        """
+        Check that the index written after editing a task can be read and
+        listed again.
+        """
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test', cache=True)
+        taskdict.edit_task('3f', "test task 3")
+        taskdict.write()
+        for _ in range(2):
+            taskdict = TaskDict(taskdir=self.taskdir, name='task_test',
+                                cache=True)
+            tmp_stdout = StringIO()
+            with contextlib.redirect_stdout(tmp_stdout):
+                taskdict.print_list()
+            self.assertEqual(tmp_stdout.getvalue(),
+                             "3 - test task 2\n4 - test task 3\n")
+        self.assertEqual(taskdict['4']['id'], TASK3_ID)
+        return
+
+    def test_index_rebuilt_after_edit(self):
+        """
+        Check that editing the task file by hand invalidates the index.
+        """
+        TaskDict(taskdir=self.taskdir, name='task_test', cache=True)
+        with open(self.path, 'a') as test_file:
+            test_file.write("test task 3\n")
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test', cache=True)
+        self.assertEqual(taskdict['41']['text'], "test task 3")
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            taskdict.print_list()
+        self.assertEqual(tmp_stdout.getvalue(), (
+            "3e - test task 2\n"
+            "3f - test task 1\n"
+            "4  - test task 3\n"
+        ))
+        return
+
+    def test_index_updated_on_write(self):
+        """
+        Check that writing tasks refreshes the index.
+        """
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test', cache=True)
+        taskdict.add_task("test task 3")
+        taskdict.write()
+        with open(self.cache_path, 'rb') as cfile:
+            record = marshal.load(cfile)
+        self.assertEqual(record['ids'], [TASK2_ID, TASK1_ID, TASK3_ID])
+        self.assertEqual(record['prefixes'], ['3e', '3f', '4'])
+        return
+
+
+class JournalTests(unittest.TestCase):
+    """
+    A set of tests for journal mode.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+        self.path = os.path.join(self.taskdir, 'task_test')
+        self.journal_path = os.path.join(self.taskdir, '.task_test.journal')
+        with open(self.path, 'w') as test_file:
+            test_file.write("test task 1\ntest task 2\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _taskdict(self):
+        return TaskDict(taskdir=self.taskdir, name='task_test', journal=True)
+
+    def test_changes_are_replayed(self):
+        """
+        Check that changes go to the journal, and are replayed on reading.
+        """
+        taskdict = self._taskdict()
+        taskdict.add_task("test task 3", tags=['a'])
+        taskdict.finish_task('3f')
+        taskdict.edit_task('3e', "test task 4")
+        taskdict.write()
+        with open(self.path, 'r') as test_file:
+            self.assertEqual(test_file.read(), "test task 1\ntest task 2\n")
+        with open(self.journal_path, 'r') as jfile:
+            self.assertEqual(len(jfile.readlines()), 3)
+        taskdict = self._taskdict()
+        self.assertEqual(sorted(task['text'] for task in
+                                taskdict.tasks.values()),
+                         ["test task 3", "test task 4"])
+        self.assertEqual(taskdict['41']['tags'], 'a')
+        self.assertEqual(list(taskdict.done), [TASK1_ID])
+        return
+
+    def test_edit_is_replayed_under_new_id(self):
+        """
+        Check that a replayed edit moves the task to its new id, so that the
+        new prefix finds it before the journal is compacted.
+        """
+        taskdict = self._taskdict()
+        taskdict.edit_task('3f', "test task 3")
+        taskdict.write()
+        taskdict = self._taskdict()
+        self.assertEqual(sorted(taskdict.tasks), [TASK2_ID, TASK3_ID])
+        self.assertEqual(taskdict['4']['text'], "test task 3")
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            taskdict.print_list()
+        self.assertEqual(tmp_stdout.getvalue(),
+                         "3 - test task 2\n4 - test task 3\n")
+        return
+
+    def test_compaction(self):
+        """
+        Check that a large journal is folded into the task files.
+        """
+        taskdict = self._taskdict()
+        taskdict.remove_task('3f')
+        with mock.patch('tld.JOURNAL_COMPACT_SIZE', 0):
+            taskdict.write()
+        self.assertFalse(os.path.exists(self.journal_path))
+        with open(self.path, 'r') as test_file:
+            self.assertEqual(test_file.read(), "test task 2 | id:{}\n".format(
+                TASK2_ID))
+        return
+
+    def test_cut_short_record(self):
+        """
+        Check that a record cut short by a crash is ignored and dropped.
+        """
+        taskdict = self._taskdict()
+        taskdict.finish_task('3f')
+        with open(self.journal_path, 'a') as jfile:
+            jfile.write("remove\t3e")
+        taskdict = self._taskdict()
+        self.assertEqual(list(taskdict.tasks), [TASK2_ID])
+        taskdict.add_task("test task 3")
+        with open(self.journal_path, 'r') as jfile:
+            self.assertEqual([line.split('\t')[0] for line in jfile],
+                             ['finish', 'add'])
+        return
+
+    def test_journal_read_without_journal_mode(self):
+        """
+        Check that a journal is replayed and removed outside journal mode.
+        """
+        self._taskdict().finish_task('3f')
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        self.assertEqual(list(taskdict.tasks), [TASK2_ID])
+        taskdict.add_task("test task 3")
+        taskdict.write()
+        self.assertFalse(os.path.exists(self.journal_path))
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        self.assertEqual(sorted(taskdict.tasks), [TASK2_ID, TASK3_ID])
+        self.assertEqual(list(taskdict.done), [TASK1_ID])
+        return
+
+
+class SegmentTests(unittest.TestCase):
+    """
+    A set of tests for done segments.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+        self.done_path = os.path.join(self.taskdir, '.task_test.done')
+        with open(os.path.join(self.taskdir, 'task_test'), 'w') as test_file:
+            test_file.write("test task 1\ntest task 2\ntest task 3\n")
+        with open(self.done_path, 'w') as test_file:
+            test_file.write(f"test task 4 | id:{TASK4_ID}\n")
+        # Last written in January 2020.
+        os.utime(self.done_path, (1579000000, 1579000000))
+        self.segment_path = self.done_path + '.' + time.strftime(
+            '%Y-%m', time.localtime(1579000000))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _taskdict(self):
+        return TaskDict(taskdir=self.taskdir, name='task_test',
+                        rotate_done=True)
+
+    def _done_list(self, taskdict, **options):
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            taskdict.print_list(kind='done', quiet=True, **options)
+        return tmp_stdout.getvalue()
+
+    def test_index_covers_segments(self):
+        """
+        Check that tag, word and query lookups in done tasks find the tasks
+        in segments, without reading the done file in full.
+        """
+        with open(self.segment_path, 'w') as test_file:
+            test_file.write(f"test task 1 | id:{TASK1_ID}; tags:work; "
+                            "date:2020-01-02\n")
+        taskdict = self._taskdict()
+        for options in ({'tag_filter': ['work']}, {'words': ['1']},
+                        {'query': 'tag:work and date<2020-02-01'}):
+            self.assertEqual(self._done_list(taskdict, **options),
+                             "test task 1\n", options)
+        self.assertEqual(self._done_list(taskdict, words=['task']),
+                         "test task 1\ntest task 4\n")
+        self.assertIsNone(taskdict._done)
+        return
+
+    def test_rotation(self):
+        """
+        Check that an old done file is moved to a segment, and that done
+        tasks are listed from all segments.
+        """
+        taskdict = self._taskdict()
+        taskdict.finish_task('3f')
+        taskdict.write()
+        with open(self.segment_path, 'r') as test_file:
+            self.assertEqual(test_file.read(),
+                             f"test task 4 | id:{TASK4_ID}\n")
+        with open(self.done_path, 'r') as test_file:
+            self.assertEqual(test_file.read(),
+                             f"test task 1 | id:{TASK1_ID}\n")
+        with mock.patch('tld.DONE_SEGMENT_SIZE', 1):
+            taskdict = self._taskdict()
+            taskdict.finish_task('3e')
+            taskdict.write()
+        self.assertTrue(os.path.exists(time.strftime(
+            self.done_path + '.%Y-%m')))
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        self.assertEqual(self._done_list(taskdict), (
+            "test task 2\ntest task 1\ntest task 4\n"
+        ))
+        self.assertEqual(taskdict.find_done('8')['text'], "test task 4")
+        return
+
+    def test_compression(self):
+        """
+        Check that compressed segments are listed and searched.
+        """
+        taskdict = self._taskdict()
+        taskdict.finish_task('3f')
+        taskdict.write()
+        taskdict.compress_done('gzip')
+        self.assertFalse(os.path.exists(self.segment_path))
+        self.assertTrue(os.path.exists(self.segment_path + '.gz'))
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        self.assertEqual(self._done_list(taskdict, grep_string='4'),
+                         "test task 4\n")
+        return
+
+    def test_delete_finished(self):
+        """
+        Check that deleting finished tasks removes the segments too.
+        """
+        taskdict = self._taskdict()
+        taskdict.finish_task('3f')
+        taskdict.write()
+        taskdict.compress_done('lzma')
+        taskdict = self._taskdict()
+        taskdict.delete_finished()
+        self.assertEqual(self._done_list(taskdict), "")
+        taskdict.write()
+        self.assertEqual(sorted(os.listdir(self.taskdir)),
+                         ['.task_test.done', 'task_test'])
+        return
+
+
+class LockTests(unittest.TestCase):
+    """
+    A set of tests for locking lists and replacing task files atomically.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lock_timeout(self):
+        """
+        Check that a writer gives up when another holds the lock too long.
+        """
+        input_args = ['-t', self.taskdir, '-l', 'task_test',
+                      '--lock-timeout', '0.1', 'test task 1']
+        with task_lock(self.taskdir, 'task_test'):
+            with self.assertRaises(IOError):
+                main(input_args=input_args)
+        main(input_args=input_args)
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        self.assertEqual(list(taskdict.tasks), [TASK1_ID])
+        return
+
+    def test_atomic_write(self):
+        """
+        Check that rewriting a task file leaves no temporary files behind and
+        keeps the permissions of the file.
+        """
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        taskdict.add_task("test task 1")
+        taskdict.write()
+        path = os.path.join(self.taskdir, 'task_test')
+        os.chmod(path, 0o640)
+        taskdict.remove_task('3f')
+        taskdict.write()
+        self.assertEqual(sorted(os.listdir(self.taskdir)), ['task_test'])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        replaced = []
+        with mock.patch('os.replace', side_effect=lambda *paths:
+                        replaced.append(paths)):
+            taskdict.add_task("test task 2")
+            taskdict.write()
+        self.assertEqual(os.path.basename(replaced[0][0]),
+                         '.task_test.{}.tmp'.format(os.getpid()))
+        return
+
+
+class TaskDirectoryTests(unittest.TestCase):
+    """
+    A set of tests for working with every list in a task directory.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+        for name, tasks in (('work', ["test task 1", "test task 2"]),
+                            ('home', ["test task 3"])):
+            taskdict = TaskDict(taskdir=self.taskdir, name=name)
+            for task in tasks:
+                taskdict.add_task(task)
+            taskdict.write()
+        taskdict.finish_task('4')
+        taskdict.write()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_names(self):
+        """
+        Check that hidden files are not taken for lists.
+        """
+        taskdirectory = TaskDirectory(taskdir=self.taskdir)
+        self.assertEqual(taskdirectory.names(), ['home', 'work'])
+        return
+
+    def test_all_lists(self):
+        """
+        Check that every list is printed in order, with prefixes unique within
+        each list, both serially and in parallel.
+        """
+        goal = (
+            "work: 3e - test task 2\n"
+            "work: 3f - test task 1\n"
+        )
+        for jobs in ('1', '2'):
+            tmp_stdout = StringIO()
+            with contextlib.redirect_stdout(tmp_stdout):
+                main(input_args=['-t', self.taskdir, '--all-lists',
+                                 '--jobs', jobs])
+            self.assertEqual(tmp_stdout.getvalue(), goal)
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            main(input_args=['-t', self.taskdir, '--all-lists', '--done'])
+        self.assertEqual(tmp_stdout.getvalue(), "home: 4 - test task 3\n")
+        return
+
+    def test_files_which_are_not_lists(self):
+        """
+        Check that files which cannot be read as lists are skipped with a
+        warning, and that no lock files are left next to them.
+        """
+        with open(os.path.join(self.taskdir, 'binary'), 'wb') as bfile:
+            bfile.write(b'\xd0\xff\n')
+        with open(os.path.join(self.taskdir, 'notes'), 'w') as nfile:
+            nfile.write("one | id:a\ntwo | id:ab\n")
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout), \
+                contextlib.redirect_stderr(StringIO()) as tmp_stderr:
+            main(input_args=['-t', self.taskdir, '--all-lists'])
+        self.assertEqual(tmp_stdout.getvalue(), (
+            "work  : 3e - test task 2\n"
+            "work  : 3f - test task 1\n"
+        ))
+        self.assertIn("Skipped binary: UnicodeDecodeError",
+                      tmp_stderr.getvalue())
+        self.assertIn("Skipped notes: KeyError", tmp_stderr.getvalue())
+        for name in ('binary', 'notes'):
+            self.assertFalse(os.path.exists(
+                os.path.join(self.taskdir, '.{}.lock'.format(name))))
+        return
+
+    def test_all_lists_csv(self):
+        """
+        Check that records of every list carry the list name, under a single
+        header.
+        """
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            main(input_args=['-t', self.taskdir, '--all-lists',
+                             '--format', 'csv'])
+        self.assertEqual(tmp_stdout.getvalue(), (
+            "list,id,prefix,text,tags,date\n"
+            "work,{},3e,test task 2,,\n"
+            "work,{},3f,test task 1,,\n".format(TASK2_ID, TASK1_ID)
+        ))
+        return
+
+
+class AsyncTests(unittest.TestCase):
+    """
+    A set of tests for the asyncio interface to a TaskDict.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def run_async(coroutine):
+        """
+        Run coroutine in a new event loop and return its result.
+
+        (asyncio.run is not available in Python 3.6.)
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_writes_are_coalesced(self):
+        """
+        Check that concurrent writes are flushed to disk together.
+        """
+        async def add_and_write(taskdict, text):
+            await taskdict.add_task(text)
+            await taskdict.write()
+
+        async def run():
+            taskdict = AsyncTaskDict(taskdir=self.taskdir, name='task_test')
+            await taskdict.load()
+            await asyncio.gather(*(
+                add_and_write(taskdict, "test task {}".format(i))
+                for i in range(1, 4)
+            ))
+
+        with mock.patch.object(TaskDict, 'write', autospec=True,
+                               side_effect=TaskDict.write) as write:
+            self.run_async(run())
+        self.assertEqual(write.call_count, 1)
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        self.assertEqual(sorted(taskdict.tasks),
+                         sorted([TASK1_ID, TASK2_ID, TASK3_ID]))
+        return
+
+    def test_journal_mutations_in_executor(self):
+        """
+        Check that in journal mode, mutations (which append to the journal)
+        are not run on the event loop's thread.
+        """
+        threads = []
+        original_log = TaskDict._log
+
+        def log(taskdict, *fields):
+            threads.append(threading.current_thread())
+            return original_log(taskdict, *fields)
+
+        async def run():
+            taskdict = AsyncTaskDict(taskdir=self.taskdir, name='task_test',
+                                     journal=True)
+            await taskdict.load()
+            await taskdict.add_task("test task 1")
+            new_id = await taskdict.edit_task('3f', "test task 2")
+            await taskdict.write()
+            return new_id
+
+        with mock.patch.object(TaskDict, '_log', autospec=True,
+                               side_effect=log):
+            self.assertEqual(self.run_async(run()), TASK2_ID)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test',
+                            journal=True)
+        self.assertEqual(list(taskdict.tasks), [TASK2_ID])
+        return
+
+    def test_changes_by_others_are_kept(self):
+        """
+        Check that a flush refuses to overwrite changes made by another
+        process since the list was read.
+        """
+        async def run():
+            taskdict = AsyncTaskDict(taskdir=self.taskdir, name='task_test')
+            await taskdict.load()
+            other = TaskDict(taskdir=self.taskdir, name='task_test')
+            other.add_task("test task 2")
+            other.write()
+            await taskdict.add_task("test task 1")
+            with self.assertRaises(IOError):
+                await taskdict.write()
+            await taskdict.load()
+            await taskdict.add_task("test task 1")
+            await taskdict.write()
+
+        self.run_async(run())
+        taskdict = TaskDict(taskdir=self.taskdir, name='task_test')
+        self.assertEqual(sorted(taskdict.tasks), [TASK2_ID, TASK1_ID])
+        return
+
+    def test_write_errors_are_raised(self):
+        """
+        Check that a failed flush raises in every waiting write.
+        """
+        async def run():
+            taskdict = AsyncTaskDict(taskdir=os.path.join(self.taskdir, 'no'),
+                                     name='task_test')
+            await taskdict.load()
+            await taskdict.add_task("test task 1")
+            results = await asyncio.gather(taskdict.write(), taskdict.write(),
+                                           return_exceptions=True)
+            return results
+
+        results = self.run_async(run())
+        self.assertTrue(all(isinstance(result, OSError) for result in results))
+        return
+
+
+class ServerTests(unittest.TestCase):
+    """
+    A set of tests for serving commands from a long-running process.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+        socket_path = os.path.join(self.taskdir, '.tld.sock')
+        self.server = _make_server(socket_path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.environ = mock.patch.dict(os.environ, {'TLD_SOCKET': socket_path})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmpdir.cleanup()
+
+    def run_main(self, *input_args):
+        """
+        Run main on the list task_test and return what it printed.
+        """
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            main(input_args=['-t', self.taskdir, '-l', 'task_test']
+                 + list(input_args))
+        return tmp_stdout.getvalue()
+
+    def test_commands_are_served(self):
+        """
+        Check that commands run by the server change and print the list.
+        """
+        self.run_main("test task 1")
+        self.run_main("test task 2")
+        self.run_main("-f", "3e")
+        self.assertEqual(self.run_main(), "3 - test task 1\n")
+        self.assertEqual(self.run_main("--done"), "3 - test task 2\n")
+        with self.assertRaises(SystemExit):
+            self.run_main("-f", "9")
+        return
+
+    def test_edit_is_served(self):
+        """
+        Check that an edited task is found by its new prefix.
+        """
+        self.run_main("test task 1")
+        self.run_main("test task 2")
+        self.run_main("-e", "3f", "test task 3")
+        self.assertEqual(self.run_main(), "3 - test task 2\n4 - test task 3\n")
+        self.run_main("-f", "4")
+        self.assertEqual(self.run_main("--done"), "4 - test task 3\n")
+        return
+
+    def test_batch_file_from_client_directory(self):
+        """
+        Check that a batch file is found relative to the client's directory.
+        """
+        with open(os.path.join(self.taskdir, 'cmds.txt'), 'w') as bfile:
+            bfile.write("test task 1\n")
+        # The server runs in this process, so only the client moves.
+        with mock.patch('os.getcwd', return_value=self.taskdir):
+            self.run_main("--batch", "cmds.txt")
+        self.assertEqual(self.run_main(), "3 - test task 1\n")
+        return
+
+    def test_all_lists_error(self):
+        """
+        Check that an error listing every list is sent back to the client.
+        """
+        missing = os.path.join(self.taskdir, 'missing')
+        with self.assertRaises(SystemExit) as exit_:
+            main(input_args=['-t', missing, '--all-lists'])
+        self.assertIn("FileNotFoundError", exit_.exception.code)
+        return
+
+    def test_usage_is_printed(self):
+        """
+        Check that help and usage errors from the server reach the client.
+        """
+        tmp_stdout = StringIO()
+        with contextlib.redirect_stdout(tmp_stdout):
+            with self.assertRaises(SystemExit) as exit_:
+                main(input_args=['-h'])
+        self.assertEqual(exit_.exception.code, 0)
+        self.assertIn("usage:", tmp_stdout.getvalue())
+        with contextlib.redirect_stderr(StringIO()) as tmp_stderr:
+            with self.assertRaises(SystemExit) as exit_:
+                self.run_main("--limit", "-1")
+        self.assertEqual(exit_.exception.code, 2)
+        self.assertIn("not a non-negative integer", tmp_stderr.getvalue())
+        return
+
+    def test_external_edit_is_seen(self):
+        """
+        Check that the server rereads a list which was edited by hand.
+        """
+        self.run_main("test task 1")
+        with open(os.path.join(self.taskdir, 'task_test'), 'a') as tfile:
+            tfile.write("test task 2\n")
+        self.assertEqual(self.run_main(),
+                         "3e - test task 2\n3f - test task 1\n")
+        return
+
+
+class InstrumentationTests(unittest.TestCase):
+    """
+    A set of tests for --timings and --profile.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.taskdir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_timings(self):
+        """
+        Check that timings of each phase are reported to stderr.
+        """
+        tmp_stderr = StringIO()
+        with contextlib.redirect_stderr(tmp_stderr):
+            main(['-t', self.taskdir, '--timings', 'test task 1'])
+        phases = [line.split()[:2] for line in
+                  tmp_stderr.getvalue().splitlines()]
+        self.assertIn(['mutation', 'add_task'], phases)
+        self.assertIn(['write', 'write'], phases)
+        self.assertEqual(phases[-1][0], 'total')
+        tmp_stderr = StringIO()
+        with contextlib.redirect_stderr(tmp_stderr), \
+                contextlib.redirect_stdout(StringIO()), \
+                mock.patch.dict(os.environ, {'TLD_TIMINGS': '1'}):
+            main(['-t', self.taskdir, '--grep', 'task'])
+        self.assertIn("filter     iter_list", tmp_stderr.getvalue())
+        return
+
+    def test_profile(self):
+        """
+        Check that --profile saves cProfile stats.
+        """
+        path = os.path.join(self.taskdir, 'tld.prof')
+        with contextlib.redirect_stdout(StringIO()):
+            main(['-t', self.taskdir, '--profile', path])
+        self.assertTrue(pstats.Stats(path).total_calls > 0)
+        return
+
+
 class BasicParserOperation(unittest.TestCase):
     """
     A set of tests for the parser.
@@ -360,6 +1610,24 @@ class BasicParserOperation(unittest.TestCase):
         options = _build_parser().parse_args(input_args)
         self.assertTrue(options.delete_finished)
 
+    def test_invalid_regex(self):
+        """
+        Test that an invalid --regex pattern is a usage error.
+        """
+        with contextlib.redirect_stderr(StringIO()) as tmp_stderr:
+            with self.assertRaises(SystemExit):
+                _parse_args(['-g', '(', '--regex'])
+        self.assertIn("invalid regular expression '('", tmp_stderr.getvalue())
+        self.assertEqual(_parse_args(['-g', '(']).grep_string, ['('])
+        return
+
+    def test_fast_path(self):
+        "Check that arguments without options are parsed as by the parser"
+        for input_args in ([], ["Buy", "milk."]):
+            options = _build_parser().parse_args(input_args)
+            self.assertEqual(vars(_parse_args(input_args)), vars(options))
+        self.assertTrue(_parse_args(["-q"]).quiet)
+
 
 class IntegrationTests(unittest.TestCase):
     """
@@ -373,6 +1641,8 @@ class IntegrationTests(unittest.TestCase):
             os.remove('integration_task_test')
         if os.path.exists('.integration_task_test.done'):
             os.remove('.integration_task_test.done')
+        if os.path.exists('.integration_task_test.lock'):
+            os.remove('.integration_task_test.lock')
 
     def test_sample_run(self):
         """
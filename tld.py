@@ -87,15 +87,184 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import argparse
-import datetime
-import hashlib
+# tld is often run many times in a row (e.g. from a shell prompt), so only
+# modules which are cheap to import, or are needed to list or add tasks, are
+# imported here. argparse, datetime, hashlib and re are imported where they
+# are used.
+import bisect
+import collections.abc
+import contextlib
+import functools
+import io
+import marshal
 import os
 import operator
-import re
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where tld does not lock.
+    fcntl = None
 
 VERSION = "1.0.1"
 
+# Number of lines collected before each write to stdout in `print_list`.
+OUTPUT_CHUNK_SIZE = 1024
+
+# Format version of the sidecar index files written when caching is enabled.
+CACHE_VERSION = 3
+
+# A task file is rewritten (and sorted) in full rather than appended to once
+# more than this fraction of its lines are out of order or no longer live.
+COMPACT_RATIO = 0.1
+
+# Seconds between attempts to take a lock when waiting with a timeout.
+LOCK_POLL_INTERVAL = 0.05
+
+# In journal mode, the journal is folded into the task files once it is at
+# least this many bytes long.
+JOURNAL_COMPACT_SIZE = 256 * 1024
+
+# When the journal is synced to disk: after every record, once per `write`, or
+# never (leaving it to the operating system).
+JOURNAL_FSYNC_POLICIES = ('always', 'write', 'never')
+
+# How ids of new tasks are made from their text: the 40 hex digits of SHA1,
+# or the 20 or 16 hex digits of a 10 or 8 byte BLAKE2b digest. Ids already in
+# a file are kept as they are.
+ID_SCHEMES = ('sha1', 'blake2b', 'short')
+
+# With done rotation, the done file is moved to a segment of its own once it
+# is this many bytes long, or was last written in an earlier month.
+DONE_SEGMENT_SIZE = 4 * 1024 * 1024
+
+# The ways done segments can be compressed, and the suffix of each.
+DONE_COMPRESSION = {'gzip': '.gz', 'lzma': '.xz'}
+
+# The orders tasks can be listed in (see `_page`).
+SORT_ORDERS = ('id', 'date', 'text', 'tag')
+
+# The formats lists can be printed in (see `_encode_tasks`).
+OUTPUT_FORMATS = ('human', 'jsonl', 'tsv', 'csv')
+
+
+class _Timings():
+    """
+    Wall time and peak memory of the phases of a run of tld.
+
+    A phase is entered with `phase(name, method)`. The time of a phase does
+    not include the time of phases entered within it, so the times add up
+    to the total. Memory is traced with tracemalloc, which slows down
+    allocation while timings are taken. Before Python 3.9 the peak of each
+    phase is the peak of the run up to its end.
+    """
+    def __init__(self):
+        import tracemalloc
+        self._tracemalloc = tracemalloc
+        # {(phase, method): [calls, seconds, peak bytes]}, in order of entry.
+        self.phases = {}
+        # For each phase entered, the time and peak of its nested phases.
+        self._stack = []
+        self._start = time.perf_counter()
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name, method):
+        """
+        Time the enclosed block as the phase `name` of `method`.
+        """
+        entry = self.phases.setdefault((name, method), [0, 0.0, 0])
+        self._stack.append([0.0, 0])
+        self._reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested, nested_peak = self._stack.pop()
+            peak = max(self._tracemalloc.get_traced_memory()[1], nested_peak)
+            entry[0] += 1
+            entry[1] += elapsed - nested
+            entry[2] = max(entry[2], peak)
+            if self._stack:
+                self._stack[-1][0] += elapsed
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+
+    def _reset_peak(self):
+        """
+        Start measuring a new peak, where tracemalloc allows it.
+        """
+        if hasattr(self._tracemalloc, 'reset_peak'):
+            if self._stack[:-1]:
+                parent = self._stack[-2]
+                parent[1] = max(parent[1],
+                                self._tracemalloc.get_traced_memory()[1])
+            self._tracemalloc.reset_peak()
+        return
+
+    def report(self, out):
+        """
+        Write a table of the phases and the total to out, and stop tracing.
+        """
+        total = time.perf_counter() - self._start
+        peak = max([self._tracemalloc.get_traced_memory()[1]] +
+                   [entry[2] for entry in self.phases.values()])
+        self._tracemalloc.stop()
+        out.write("{:<10} {:<16} {:>6} {:>10} {:>10}\n".format(
+            "phase", "method", "calls", "wall ms", "peak KiB"))
+        for (name, method), (calls, seconds, phase_peak) in \
+                self.phases.items():
+            out.write("{:<10} {:<16} {:>6} {:>10.3f} {:>10.1f}\n".format(
+                name, method, calls, 1000 * seconds, phase_peak / 1024))
+        out.write("{:<10} {:<16} {:>6} {:>10.3f} {:>10.1f}\n".format(
+            "total", "", "", 1000 * total, peak / 1024))
+        return
+
+
+# The _Timings of the current run, if timings were asked for.
+_TIMINGS = None
+
+
+class _NotTimed():
+    """
+    A context manager which does nothing, used when timings are off.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOT_TIMED = _NotTimed()
+
+
+def _timed_phase(name, method):
+    """
+    Return a context manager timing the phase `name` of `method`, if timings
+    are being taken.
+    """
+    if _TIMINGS is None:
+        return _NOT_TIMED
+    return _TIMINGS.phase(name, method)
+
+
+def _timed(name):
+    """
+    Decorate a method so that each call is timed as the phase `name`, if
+    timings are being taken.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if _TIMINGS is None:
+                return method(*args, **kwargs)
+            with _TIMINGS.phase(name, method.__name__):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
 
 class TaskDict():
     """
@@ -104,183 +273,2141 @@ class TaskDict():
     TaskDict recognizes two collections of tasks: regular and done. These are
     stored separately.
 
-    A task is a dictionary
+    A task is a `Task`, which behaves like the dictionary
 
         {
           'id': <hash_id>,
           'text': <summary_text>,
           ... other metadata ...
         }
+
+    The ids of the regular tasks are also kept in a sorted index, which is
+    used to resolve prefixes given on the command line.
+
+    Changes are tracked per collection so that `write` only touches the files
+    that changed. Pure additions are appended to the end of the file. Removals
+    and edits, or files with too many unsorted or dead lines, cause a full
+    sorted rewrite.
+
+    The done file is only read when `done` is first accessed. Finishing a task
+    does not access it, so tasks can be finished without reading the done file.
+
+    If cache is True, each task file gets a binary sidecar index (e.g.
+    `.tasks.idx`) holding its parsed tasks, sorted ids and prefixes. The index
+    is used in place of parsing the file as long as the file's modification
+    time and size, or failing that its content hash, are unchanged.
+
+    If journal is True, each change is also appended as one line to a journal
+    file (e.g. `.tasks.journal`), synced to disk according to fsync (one of
+    JOURNAL_FSYNC_POLICIES). `write` then leaves the task files alone until
+    the journal reaches JOURNAL_COMPACT_SIZE bytes, when `compact` folds it
+    into them. Whenever a journal exists, it is replayed over the task files
+    when they are read, so a change is never lost once its record is on disk.
+
+    New ids are made with id_scheme, one of ID_SCHEMES. Tasks read from a file
+    keep the ids written in it, so lists can change scheme at any time.
+
+    Older done tasks can be kept in segments next to the done file, named by
+    month (e.g. `.tasks.done.2026-10`, then `.tasks.done.2026-10.2`, ...) and
+    perhaps compressed (`.tasks.done.2026-10.gz`). If rotate_done is True,
+    `write` moves the done file to a new segment when it is larger than
+    DONE_SEGMENT_SIZE or was last written in an earlier month, so that the
+    done file stays small. Segments are only read to list done tasks.
     """
-    def __init__(self, taskdir='.', name='tasks'):
+    # pylint complains about the number of arguments, but each one is a
+    # separate option of how the tasks are stored.
+    def __init__(self,              # pylint: disable=too-many-arguments
+                 taskdir='.', name='tasks', cache=False, journal=False,
+                 fsync='write', id_scheme='sha1', rotate_done=False):
         """
         Read tasks from taskfiles if they exist.
         """
+        if fsync not in JOURNAL_FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy: {}.".format(fsync))
+        if id_scheme not in ID_SCHEMES:
+            raise ValueError("Unknown id scheme: {}.".format(id_scheme))
         self.tasks = {}
-        self.done = {}
         self.name = name
         self.taskdir = os.path.expanduser(taskdir)
-        filemap = (
-            ('tasks', self.name),
-            ('done', '.{}.done'.format(self.name)),
+        self.cache = cache
+        self.journal = journal
+        self.fsync = fsync
+        self.id_scheme = id_scheme
+        self.rotate_done = rotate_done
+        # Whether changes are currently being replayed from the journal
+        # (and so are not journaled again), whether records were added since
+        # the journal was last synced, and the length of the journal up to
+        # its last complete record, if a later record was cut short.
+        self._replaying = False
+        self._unsynced = False
+        self._journal_end = None
+        # Sorted ids and their prefixes for collections read from an index,
+        # dropped as soon as the collection changes.
+        self._cached_prefixes = {}
+        # Inverted indexes of words and tags, built on the first query of each
+        # collection and dropped as soon as the collection changes.
+        self._terms = {}
+        # The `_ArchiveFile` of each done file or segment that was listed, or
+        # its tasks if it has lines without ids. Dropped when files are
+        # written.
+        self._archives = {}
+        # Whether the done segments are to be removed on the next write.
+        self._drop_segments = False
+        # The done collection is None until it is read. Tasks finished before
+        # then are kept in _finished.
+        self._done = None
+        self._finished = {}
+        # Lines in each file, and how many of those are stale (out of sorted
+        # order, or shadowed by a later line with the same id). These are None
+        # while the file has not been read.
+        self._lines = {'tasks': 0, 'done': None}
+        self._stale = {'tasks': 0, 'done': None}
+        # Ids added to each collection since the last write, and the
+        # collections which can only be saved by a full rewrite.
+        self._appended = {'tasks': [], 'done': []}
+        self._rewrite = set()
+        self._read('tasks', self.tasks)
+        if 'tasks' in self._cached_prefixes:
+            self._index = _IdIndex(self._cached_prefixes['tasks'][0],
+                                   presorted=True)
+        else:
+            self._index = _IdIndex(self.tasks)
+        self._replay()
+        return
+
+    @property
+    def done(self):
+        """
+        The collection of done tasks, read from its file on first access.
+        """
+        if self._done is None:
+            self._lines['done'] = self._stale['done'] = 0
+            self._done = {}
+            self._read('done', self._done)
+            for id_, task in self._finished.items():
+                if id_ in self._done:
+                    self._mark_rewrite('done')
+                self._done[id_] = task
+                self._cached_prefixes.pop('done', None)
+            self._finished = {}
+        return self._done
+
+    @done.setter
+    def done(self, tasks):
+        self._done = tasks
+        self._finished = {}
+        return
+
+    @_timed('parse')
+    def _read(self, kind, collection):
+        """
+        Read the file of the collection `kind` into collection, if it exists.
+        """
+        path = self._path(kind)
+        if not os.path.exists(path):
+            return
+        if self.cache:
+            record = _read_cache(path, self._cache_path(kind),
+                                 self.id_scheme)
+            if record is not None:
+                collection.update((task.id, task) for task in
+                                  map(Task.from_record, record['tasks']))
+                self._lines[kind] += record['lines']
+                self._stale[kind] += record['stale']
+                if record['prefixes'] is not None:
+                    self._cached_prefixes[kind] = (record['ids'],
+                                                   record['prefixes'])
+                return
+        with open(path, 'r') as tfile:
+            self._load(kind, collection, _iter_tasks(tfile, self.id_scheme))
+        if self.cache:
+            self._write_cache(kind, path)
+        return
+
+    def _journal_path(self):
+        """
+        Return the path of the journal of this list.
+        """
+        return os.path.join(self.taskdir, '.{}.journal'.format(self.name))
+
+    @_timed('parse')
+    def _replay(self):
+        """
+        Apply the changes recorded in the journal, if there is one.
+
+        A last record without its newline was cut short by a crash, and is
+        ignored. Records which no longer apply (e.g. after the task files were
+        edited by hand) are skipped.
+        """
+        path = self._journal_path()
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as jfile:
+            content = jfile.read()
+        records = content.split('\n')
+        if records[-1]:
+            self._journal_end = len(content.encode()) - len(
+                records[-1].encode())
+        self._replaying = True
+        try:
+            for record in records[:-1]:
+                try:
+                    self._apply(record)
+                except (KeyError, IOError, ValueError):
+                    continue
+        finally:
+            self._replaying = False
+        return
+
+    def _apply(self, record):
+        """
+        Apply one journal record, as written by `_log`.
+        """
+        action, _, rest = record.partition('\t')
+        if action == 'add':
+            self.add_taskline(rest)
+        elif action == 'edit':
+            key, _, taskline = rest.partition('\t')
+            if key not in self.tasks:
+                raise KeyError("Task {} not in tasklist.".format(key))
+            self._replace_task(key, _task_from_taskline(taskline,
+                                                        self.id_scheme))
+        elif action == 'finish':
+            self.finish_task(rest)
+        elif action == 'remove':
+            self.remove_task(rest)
+        elif action == 'delete_finished':
+            self.delete_finished()
+        else:
+            raise ValueError("Unknown journal record: {}.".format(action))
+        return
+
+    def _log(self, *fields):
+        """
+        Append a record of a change to the journal, in journal mode.
+        """
+        if not self.journal or self._replaying:
+            return
+        path = self._journal_path()
+        if self._journal_end is not None:
+            # Drop a record cut short by a crash before adding to the journal.
+            os.truncate(path, self._journal_end)
+            self._journal_end = None
+        with open(path, 'a') as jfile:
+            jfile.write('\t'.join(fields) + '\n')
+            if self.fsync == 'always':
+                jfile.flush()
+                os.fsync(jfile.fileno())
+            else:
+                self._unsynced = True
+        return
+
+    def _taskline(self, task):
+        """
+        Return the line of a task file for task, without its newline.
+        """
+        return _tasklines_from_tasks([task])[0][:-1]
+
+    def _cache_path(self, kind):
+        """
+        Return the path of the sidecar index of the collection `kind`.
+        """
+        if kind == 'tasks':
+            filename = '.{}.idx'.format(self.name)
+        else:
+            filename = '.{}.done.idx'.format(self.name)
+        return os.path.join(os.path.realpath(self.taskdir), filename)
+
+    def _write_cache(self, kind, path, content=None):
+        """
+        Write the sidecar index of the collection `kind`.
+
+        content is the text of the task file, which is read if not given.
+        """
+        if content is None:
+            with open(path, 'r') as tfile:
+                content = tfile.read()
+        collection = getattr(self, kind)
+        # The tasks are read back under their own ids, so those are indexed.
+        ids = sorted(task.id for task in collection.values())
+        try:
+            prefixes = [prefix for _, prefix in _iter_prefixes(ids)]
+        except KeyError:
+            prefixes = None
+        stat = os.stat(path)
+        record = {
+            'version': CACHE_VERSION,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'hash': _content_hash(content),
+            'lines': self._lines[kind],
+            'stale': self._stale[kind],
+            'tasks': [task.to_record() for task in collection.values()],
+            'ids': ids,
+            'prefixes': prefixes,
+            'id_scheme': self.id_scheme,
+        }
+        _atomic_write(self._cache_path(kind), marshal.dumps(record), 'wb')
+        return
+
+    def _in_memory(self, kind):
+        """
+        Return the tasks of the collection `kind` which are held in memory.
+
+        For an unread done collection, these are the tasks finished since.
+        """
+        if kind == 'done' and self._done is None:
+            return self._finished
+        return getattr(self, kind)
+
+    def _listed(self, kind):
+        """
+        Return the collection `kind` as a mapping from ids to tasks.
+
+        Done tasks are viewed through an `_Archive` of the done file (or the
+        done collection, once it is read) and the done segments, newest first.
+        Files are only read in full if they have lines without ids.
+        """
+        if kind == 'tasks':
+            return self.tasks
+        segments = self._segment_paths()
+        if self._done is not None and not segments:
+            return self._done
+        if self._done is not None:
+            layers = [self._done]
+        else:
+            layers = [self._finished, self._archive_layer(self._path('done'))]
+        layers.extend(map(self._archive_layer, segments))
+        return _Archive(layers)
+
+    def _archive_layer(self, path):
+        """
+        Return the `_ArchiveFile` of a done file or segment, or a dictionary
+        of its tasks if it cannot be indexed.
+        """
+        if path not in self._archives:
+            try:
+                layer = _ArchiveFile(path)
+            except ValueError:
+                content = _read_archive_bytes(path)[:].decode('utf-8')
+                layer = {task.id: task for task in
+                         _iter_tasks(content, self.id_scheme)}
+            self._archives[path] = layer
+        return self._archives[path]
+
+    def _segment_paths(self):
+        """
+        Return the paths of the done segments, newest first.
+        """
+        if self._drop_segments:
+            return []
+        prefix = '.{}.done.'.format(self.name)
+        taskdir = os.path.realpath(self.taskdir)
+        try:
+            names = os.listdir(taskdir)
+        except OSError:
+            return []
+        segments = []
+        for filename in names:
+            if not filename.startswith(prefix):
+                continue
+            rest = filename[len(prefix):]
+            if rest[-3:] in DONE_COMPRESSION.values():
+                rest = rest[:-3]
+            period, _, number = rest.partition('.')
+            if (len(period) == 7 and period[4] == '-'
+                    and (period[:4] + period[5:]).isdigit()
+                    and (number.isdigit() or not number)):
+                segments.append(((period, int(number or 1)),
+                                 os.path.join(taskdir, filename)))
+        return [path for _, path in sorted(segments, reverse=True)]
+
+    def _rotate_done(self):
+        """
+        Move the done file to a new segment, if it is due.
+
+        The done file is only rotated while it is unread, so that it is not
+        written again in full afterwards.
+        """
+        path = self._path('done')
+        if self._done is not None or not os.path.isfile(path):
+            return
+        stat = os.stat(path)
+        period = time.strftime('%Y-%m', time.localtime(stat.st_mtime))
+        if stat.st_size == 0 or (stat.st_size < DONE_SEGMENT_SIZE and
+                                 period == time.strftime('%Y-%m')):
+            return
+        number = 1
+        segment = '{}.{}'.format(path, period)
+        while any(os.path.exists(segment + suffix)
+                  for suffix in ('',) + tuple(DONE_COMPRESSION.values())):
+            number += 1
+            segment = '{}.{}.{}'.format(path, period, number)
+        os.replace(path, segment)
+        if os.path.isfile(self._cache_path('done')):
+            os.remove(self._cache_path('done'))
+        return
+
+    def compress_done(self, method='gzip'):
+        """
+        Compress every uncompressed done segment with method, a key of
+        DONE_COMPRESSION.
+        """
+        if method == 'gzip':
+            import gzip
+            compress = gzip.compress
+        elif method == 'lzma':
+            import lzma
+            compress = lzma.compress
+        else:
+            raise ValueError("Unknown compression: {}.".format(method))
+        for path in self._segment_paths():
+            if path[-3:] in DONE_COMPRESSION.values():
+                continue
+            with open(path, 'rb') as sfile:
+                content = sfile.read()
+            _atomic_write(path + DONE_COMPRESSION[method], compress(content),
+                          'wb')
+            os.remove(path)
+            self._archives.pop(path, None)
+        return
+
+    def find_done(self, prefix):
+        """
+        Return the done task with given prefix, from the done file or its
+        segments.
+
+        If more than one item found, raise an exception. The files are not
+        read in full unless they have lines without ids.
+        """
+        tasks = self._listed('done')
+        return tasks[_IdIndex(tasks).find(prefix)]
+
+    def _path(self, kind):
+        """
+        Return the path of the file storing the collection `kind`.
+        """
+        if kind == 'tasks':
+            filename = self.name
+        else:
+            filename = '.{}.done'.format(self.name)
+        path = os.path.join(os.path.realpath(self.taskdir), filename)
+        if os.path.isdir(path):
+            raise IOError("Invalid task file. File is a directory.")
+        return path
+
+    def _load(self, kind, collection, tasks):
+        """
+        Store parsed tasks in the collection `kind`, counting stale lines.
+        """
+        previous = ''
+        unsorted = 0
+        lines = 0
+        for task in tasks:
+            lines += 1
+            if unsorted or task.id < previous:
+                unsorted += 1
+            previous = task.id
+            collection[task.id] = task
+        self._lines[kind] += lines
+        self._stale[kind] += max(unsorted, lines - len(collection))
+        return
+
+    def _mark_added(self, kind, id_):
+        """
+        Record that id_ was added to the collection `kind`.
+
+        Adding an id that is already present replaces a line in the file, so
+        this requires a rewrite.
+        """
+        if id_ in self._in_memory(kind):
+            self._mark_rewrite(kind)
+        else:
+            self._appended[kind].append(id_)
+            self._cached_prefixes.pop(kind, None)
+            self._terms.pop(kind, None)
+        return
+
+    def _mark_rewrite(self, kind):
+        """
+        Record that the file of the collection `kind` must be rewritten.
+        """
+        self._rewrite.add(kind)
+        self._cached_prefixes.pop(kind, None)
+        self._terms.pop(kind, None)
+        return
+
+    def _term_index(self, kind):
+        """
+        Return the inverted index of the collection `kind`, building it if
+        needed.
+
+        Done tasks are indexed through `_listed`, so the index covers the
+        done segments, and the done file is not read into memory.
+        """
+        if kind not in self._terms:
+            self._terms[kind] = _TermIndex(self._listed(kind))
+        return self._terms[kind]
+
+    def __getitem__(self, prefix):
+        """
+        Return task with given prefix.
+
+        If more than one item found, raise an exception.
+        """
+        return self.tasks[self._index.find(prefix)]
+
+    @_timed('mutation')
+    def add_task(self, text, tags=(), dated=False):
+        """
+        Create a task with associated text.
+        """
+        id_ = _hash(text, self.id_scheme)
+        self._mark_added('tasks', id_)
+        if dated:
+            import datetime
+            date = datetime.date.today()
+        else:
+            date = None
+        self.tasks[id_] = Task(id_, text, tuple(tags or ()), date)
+        self._index.add(id_)
+        self._log('add', self._taskline(self.tasks[id_]))
+        return
+
+    @_timed('mutation')
+    def add_taskline(self, taskline, tags=(), dated=False):
+        """
+        Add a task given as a line of a task file.
+
+        A line with metadata is added as it is, keeping its id. A line with
+        only text is added as by `add_task`.
+        """
+        if '|' not in taskline:
+            self.add_task(taskline.strip(), tags=tags, dated=dated)
+            return
+        task = _task_from_taskline(taskline, self.id_scheme)
+        self._mark_added('tasks', task.id)
+        self.tasks[task.id] = task
+        self._index.add(task.id)
+        self._log('add', self._taskline(task))
+        return
+
+    @_timed('mutation')
+    def run_batch(self, lines, tags=(), dated=False):
+        """
+        Apply a batch of commands, one per line, and return a summary.
+
+        Each line is one of
+
+            -f TASK                 finish TASK
+            -r TASK                 remove TASK
+            -e TASK TEXT            edit TASK to TEXT (or s/old/new)
+            TASKLINE                add TASKLINE, as in `add_taskline`
+
+        Blank lines are ignored. Every TASK prefix is resolved against the
+        tasks as they were before the batch, so that earlier commands do not
+        change what later prefixes refer to; a task edited in the batch is
+        still found by its original prefix. A failing command is reported
+        and skipped; the others are still applied.
+
+        The summary has one line per command, followed by a count of the
+        commands applied and failed. Nothing is written to disk.
+        """
+        import re
+        snapshot = _IdIndex(self._index.ids, presorted=True)
+        # The ids of the tasks edited in the batch, by their original ids.
+        moved = {}
+        report = []
+        failed = 0
+        for lineno, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            action, _, rest = line.partition(' ')
+            try:
+                if action in ('-f', '-r', '-e'):
+                    prefix, _, text = rest.strip().partition(' ')
+                    original = snapshot.find(prefix)
+                    key = moved.get(original, original)
+                    if key not in self.tasks:
+                        raise KeyError("Task {} was already finished or "
+                                       "removed.".format(prefix))
+                    summary = _batch_summary(self.tasks[key])
+                    if action == '-f':
+                        self.finish_task(key)
+                        result = "finished " + summary
+                    elif action == '-r':
+                        self.remove_task(key)
+                        result = "removed " + summary
+                    else:
+                        moved[original] = self.edit_task(key, text.strip(),
+                                                         tags=tags)
+                        result = "edited " + _batch_summary(
+                            self.tasks[moved[original]])
+                else:
+                    self.add_taskline(line, tags=tags, dated=dated)
+                    id_ = _task_from_taskline(line, self.id_scheme).id
+                    result = "added " + _batch_summary(self.tasks[id_])
+            # KeyError and IOError are how TaskDict reports bad prefixes and
+            # bad edits; re.error comes from s/old/new edits.
+            except (KeyError, IOError, re.error) as err:
+                failed += 1
+                message = err.args[0] if err.args else err
+                result = "error: {}".format(message)
+            report.append("{}: {}\n".format(lineno, result))
+        report.append("{} applied, {} failed\n".format(
+            len(report) - failed, failed))
+        return report
+
+    @_timed('mutation')
+    def delete_finished(self):
+        """
+        Clears the 'done' list (and file, and segments) of tasks.
+        """
+        self.done = {}
+        self._drop_segments = True
+        self._mark_rewrite('done')
+        self._log('delete_finished')
+        return
+
+    @_timed('mutation')
+    def edit_task(self, prefix, text, tags=()):
+        """
+        Edit the task with given prefix to contain given text, and return
+        the new id of the task.
+
+        Allow also perl-style `s/old/new` replacements on text.
+        """
+        import re
+        key = self._index.find(prefix)
+        task = self.tasks[key]
+        # Allow perl-style s/old/new replacement
+        if text.startswith('s/'):
+            text = text[2:].strip('/')
+            find, _, repl = text.partition('/')
+            if not repl:
+                raise IOError("perl-string {} malformed.".format('s/' + text))
+            text = re.sub(find, repl, task['text'])
+        task['text'] = text
+        task['id'] = _hash(text, self.id_scheme)
+        if tags:
+            task['tags'] = ','.join(tags)
+        self._replace_task(key, task)
+        self._log('edit', key, self._taskline(task))
+        return task.id
+
+    def _replace_task(self, key, task):
+        """
+        Put task in place of the task with id key, under the id of task.
+
+        An edited task has a new id, so it is moved to its new key in tasks
+        and in the index, as if the file had been read again.
+        """
+        del self.tasks[key]
+        self._index.discard(key)
+        self.tasks[task.id] = task
+        self._index.add(task.id)
+        self._mark_rewrite('tasks')
+        return
+
+    @_timed('mutation')
+    def finish_task(self, prefix):
+        """
+        Remove a task with associated prefix and mark it `done`.
+        """
+        key = self._index.find(prefix)
+        task = self.tasks.pop(key)
+        self._index.discard(key)
+        self._mark_rewrite('tasks')
+        self._mark_added('done', task.id)
+        self._in_memory('done')[task.id] = task
+        self._log('finish', key)
+        return
+
+    @_timed('mutation')
+    def remove_task(self, prefix):
+        """
+        Remove a task with associated prefix (without adding it to `done`).
+        """
+        key = self._index.find(prefix)
+        self.tasks.pop(key)
+        self._index.discard(key)
+        self._mark_rewrite('tasks')
+        self._log('remove', key)
+        return
+
+    def file_signatures(self):
+        """
+        Return values which change whenever the task files change.
+        """
+        signatures = []
+        for path in (self._path('tasks'), self._path('done'),
+                     self._journal_path()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                signatures.append(None)
+            else:
+                signatures.append((stat.st_ino, stat.st_size,
+                                   stat.st_mtime_ns))
+        return signatures
+
+    @_timed('write')
+    def write(self, delete_if_empty=False):
+        """
+        Saves tasklist.
+
+        Only collections which changed since they were read are written. In
+        journal mode, the changes are already in the journal, which is only
+        synced here; the task files are written once the journal is due for
+        compaction.
+        """
+        path = self._journal_path()
+        if self.journal:
+            if self._unsynced:
+                if self.fsync == 'write':
+                    with open(path, 'a') as jfile:
+                        os.fsync(jfile.fileno())
+                self._unsynced = False
+            if (not os.path.exists(path)
+                    or os.path.getsize(path) < JOURNAL_COMPACT_SIZE):
+                return
+        self.compact(delete_if_empty)
+        return
+
+    def compact(self, delete_if_empty=False):
+        """
+        Write all changes to the task files, and remove the journal.
+        """
+        self._archives = {}
+        self._terms.pop('done', None)
+        if self._drop_segments:
+            self._drop_segments = False
+            for path in self._segment_paths():
+                os.remove(path)
+        elif self.rotate_done:
+            self._rotate_done()
+        for kind in ('tasks', 'done'):
+            path = self._path(kind)
+            if self._is_empty(kind, path) and delete_if_empty:
+                for filename in (path, self._cache_path(kind)):
+                    if os.path.isfile(filename):
+                        os.remove(filename)
+            elif kind in self._rewrite or not os.path.exists(path):
+                if kind in self._rewrite or self._appended[kind]:
+                    self._write_full(kind, path)
+            elif self._appended[kind]:
+                self._write_appended(kind, path)
+            self._appended[kind] = []
+        self._rewrite.clear()
+        path = self._journal_path()
+        if os.path.exists(path):
+            os.remove(path)
+        self._journal_end = None
+        return
+
+    def _is_empty(self, kind, path):
+        """
+        Return whether the collection `kind` is empty, without reading it.
+        """
+        if self._in_memory(kind):
+            return False
+        if kind == 'done' and self._done is None:
+            return not os.path.isfile(path) or os.path.getsize(path) == 0
+        return True
+
+    def _write_full(self, kind, path):
+        """
+        Rewrite the file of the collection `kind`, sorted by id.
+        """
+        tasks = sorted(getattr(self, kind).values(),
+                       key=operator.attrgetter('id'))
+        content = ''.join(_tasklines_from_tasks(tasks))
+        _atomic_write(path, content)
+        self._lines[kind] = len(tasks)
+        self._stale[kind] = 0
+        if self.cache:
+            self._write_cache(kind, path, content)
+        return
+
+    def _write_appended(self, kind, path):
+        """
+        Append the tasks added to the collection `kind` to its file.
+
+        Fall back to a full rewrite if too much of the file would be stale.
+        Files which were never read are always appended to.
+        """
+        collection = self._in_memory(kind)
+        appended = sorted(id_ for id_ in self._appended[kind]
+                          if id_ in collection)
+        if self._lines[kind] is None:
+            lines = stale = None
+        else:
+            lines = self._lines[kind] + len(appended)
+            stale = self._stale[kind] + len(appended)
+            if stale > COMPACT_RATIO * lines:
+                self._write_full(kind, path)
+                return
+        tasks = [collection[id_] for id_ in appended]
+        # A file edited by hand might not end with a newline.
+        with open(path, 'rb') as tfile:
+            tfile.seek(0, os.SEEK_END)
+            newline = tfile.tell() > 0
+            if newline:
+                tfile.seek(-1, os.SEEK_END)
+                newline = tfile.read(1) != b'\n'
+        with open(path, 'a') as tfile:
+            if newline:
+                tfile.write('\n')
+            tfile.write(''.join(_tasklines_from_tasks(tasks)))
+        self._lines[kind] = lines
+        self._stale[kind] = stale
+        if self.cache and lines is not None:
+            self._write_cache(kind, path)
+        return
+
+    # pylint complains about this method having too many arguments. But as the
+    # arguments are clear and have sane defaults, I simply disable the warning.
+    # It would also be possible to pass in the options datastructure directly,
+    # but that would lengthen the control logic in this function.
+    @_timed('format')
+    def print_list(self,            # pylint: disable=too-many-arguments
+                   kind='tasks',
+                   quiet=False,
+                   grep_string='',
+                   showtags=False,
+                   showdates=False,
+                   longname=False,
+                   regex=False,
+                   match_any=False,
+                   tag_filter=None,
+                   words=None,
+                   sort='id',
+                   limit=None,
+                   offset=0,
+                   output_format='human',
+                   query=None):
+        """
+        Output tasklist.
+
+        Lines are written to stdout in chunks as they are formatted. If stdout
+        is closed early (e.g. `tld | head`), printing stops quietly.
+        """
+        lines = self.iter_list(kind=kind,
+                               quiet=quiet,
+                               grep_string=grep_string,
+                               showtags=showtags,
+                               showdates=showdates,
+                               longname=longname,
+                               regex=regex,
+                               match_any=match_any,
+                               tag_filter=tag_filter,
+                               words=words,
+                               sort=sort,
+                               limit=limit,
+                               offset=offset,
+                               output_format=output_format,
+                               query=query)
+        _write_lines(lines)
+        return
+
+    def iter_list(self,             # pylint: disable=too-many-arguments
+                  kind='tasks',
+                  quiet=False,
+                  grep_string='',
+                  showtags=False,
+                  showdates=False,
+                  longname=False,
+                  regex=False,
+                  match_any=False,
+                  tag_filter=None,
+                  words=None,
+                  sort='id',
+                  limit=None,
+                  offset=0,
+                  output_format='human',
+                  list_name=None,
+                  query=None):
+        """
+        Yield the formatted lines of the tasklist, sorted by id.
+
+        grep_string is a string or a list of strings, matched against the text
+        and tags of each task as described in `_compile_matcher`. Tasks are
+        filtered before any prefix is computed. Prefixes of the matches are
+        computed from their neighbors in the full list, so they remain unique.
+
+        tag_filter and words are lists of tags and words looked up in the
+        inverted index of the collection, as described in `_TermIndex`. A
+        task must have all of them, or any of them if match_any is True, and
+        must also match grep_string. Only the tasks found in the index are
+        visited, so a lookup takes time in proportion to its result.
+
+        query is a query string, compiled by `_compile_query`, which tasks
+        must also match. If it has tag or date terms which narrow it down,
+        only the tasks found for these in the inverted index are tested.
+
+        If sort is not 'id', or limit or offset is given, only the page of
+        the matching tasks chosen by `_page` is listed, and the width of the
+        prefix column fits that page. Prefixes are still unique in the whole
+        list.
+
+        If output_format is not 'human', each task is instead encoded by
+        `_encode_tasks` with all of its fields, and quiet, showtags and
+        showdates are ignored. list_name, if given, is added to each record.
+
+        The collection is not copied, and prefixes are computed on the fly.
+        The widths of the prefix and date columns are found in a first pass.
+        An unread done file is listed through an `_Archive`, so only the
+        lines which are printed (and not all of those, if the output is
+        closed early) are decoded.
+        """
+        tasks = self._listed(kind)
+        cached = self._cached_prefixes.get(kind)
+        if cached is not None:
+            ids = cached[0]
+        elif kind == 'tasks':
+            ids = self._index.ids
+        else:
+            ids = sorted(tasks)
+        minsize = 6 if longname else 0
+        matcher = _compile_matcher(grep_string, regex=regex,
+                                   match_any=match_any)
+        query = _compile_query(query) if query else None
+        filtered = (matcher is not None or bool(tag_filter or words)
+                    or query is not None)
+        paged = sort != 'id' or limit is not None or offset
+        human = output_format == 'human'
+        with _timed_phase('filter' if filtered else 'prefixes', 'iter_list'):
+            found = None
+            if tag_filter or words:
+                found = self._term_index(kind).lookup(
+                    words=words, tags=tag_filter, match_any=match_any)
+            elif matcher is not None and isinstance(tasks, _Archive):
+                # Only the lines whose bytes match need to be decoded.
+                found = tasks.search(grep_string, regex=regex,
+                                     match_any=match_any)
+            if query is not None:
+                if query.indexed:
+                    hits = query.lookup(self._term_index(kind))
+                    found = hits if found is None else found & hits
+                if matcher is None:
+                    matcher = query.test
+                else:
+                    matcher = _both(matcher, query.test)
+            if paged:
+                if found is not None:
+                    ids_found = sorted(found)
+                    if matcher is not None:
+                        ids_found = [id_ for id_ in ids_found
+                                     if matcher(tasks[id_])]
+                elif matcher is not None:
+                    ids_found = [id_ for id_ in ids if matcher(tasks[id_])]
+                else:
+                    ids_found = ids
+                page = _page(ids_found, tasks, sort=sort, limit=limit,
+                             offset=offset)
+                prefixes = [
+                    (id_, _prefix_at(ids, bisect.bisect_left(ids, id_),
+                                     minsize))
+                    for id_ in page
+                ]
+                selected = [tasks[id_] for id_ in page]
+                plen = max((len(prefix) for _, prefix in prefixes), default=0)
+            elif found is not None:
+                prefixes = [
+                    (id_, _prefix_at(ids, bisect.bisect_left(ids, id_),
+                                     minsize))
+                    for id_ in sorted(found)
+                    if matcher is None or matcher(tasks[id_])
+                ]
+                selected = [tasks[id_] for id_, _ in prefixes]
+                plen = max((len(prefix) for _, prefix in prefixes), default=0)
+            elif matcher is None and cached is not None and not minsize:
+                selected = tasks.values()
+                prefixes = zip(ids, cached[1])
+                plen = max(map(len, cached[1]), default=0)
+            elif matcher is None:
+                selected = tasks.values()
+                prefixes = _iter_prefixes(ids, minsize)
+                plen = max((len(prefix) for _, prefix
+                            in _iter_prefixes(ids, minsize)),
+                           default=0) if human else 0
+            else:
+                prefixes = [(id_, _prefix_at(ids, i, minsize))
+                            for i, id_ in enumerate(ids)
+                            if matcher(tasks[id_])]
+                selected = [tasks[id_] for id_, _ in prefixes]
+                plen = max((len(prefix) for _, prefix in prefixes), default=0)
+        if not human:
+            yield from _encode_tasks(
+                ((prefix, tasks[id_]) for id_, prefix in prefixes),
+                output_format, list_name=list_name)
+            return
+        if showdates:
+            dlen = max(
+                (len(str(task.get('date', ''))) for task in selected),
+                default=0
+            )
+        for id_, prefix in prefixes:
+            taskval = tasks[id_]
+            tags = taskval.get('tags', '')
+            if showdates:
+                start = str(taskval.get('date', ''))
+                start = start.ljust(dlen)
+                if dlen:
+                    start += ' | '
+            else:
+                start = ''
+            if not quiet:
+                start += '{} - '.format(prefix.ljust(plen))
+            report = start + taskval['text']
+            if showtags and tags:
+                report += ' | tags: ' + ', '.join(tags.split(','))
+            yield report + '\n'
+
+
+@contextlib.contextmanager
+def task_lock(taskdir='.', name='tasks', exclusive=True, timeout=None,
+              create=True):
+    """
+    Hold an advisory lock on the list `name` in taskdir.
+
+    The lock is taken with flock on the file `.{name}.lock`. Writers take an
+    exclusive lock around reading, changing and writing a list, so concurrent
+    runs of tld apply their changes one after the other. Readers take a shared
+    lock, so that they never see a partly appended file.
+
+    If timeout is a number of seconds, give up waiting after that long and
+    raise an IOError. Otherwise wait as long as it takes.
+
+    If a shared lock cannot be taken because the lock file cannot be created
+    (e.g. in a read-only directory), continue without it. If create is
+    False, a shared lock is only taken if the lock file already exists. Where
+    flock is not available, no locking is done.
+    """
+    if fcntl is None:
+        yield
+        return
+    path = os.path.join(os.path.realpath(os.path.expanduser(taskdir)),
+                        '.{}.lock'.format(name))
+    try:
+        lockfile = open(path, 'a' if create or exclusive else 'r')
+    except OSError:
+        if exclusive:
+            raise
+        yield
+        return
+    with lockfile:
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if timeout is None:
+            fcntl.flock(lockfile, operation)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(lockfile, operation | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise IOError("Timed out waiting for lock "
+                                      "on {}.".format(path))
+                    time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class TaskDirectory():
+    """
+    All of the lists in a task directory.
+
+    Every regular file in taskdir whose name does not start with '.' is a list.
+    (tld keeps its own files, such as done files and locks, hidden.)
+    """
+    def __init__(self, taskdir='.', cache=False, id_scheme='sha1'):
+        self.taskdir = os.path.expanduser(taskdir)
+        self.cache = cache
+        self.id_scheme = id_scheme
+
+    def names(self):
+        """
+        Return the sorted names of the lists in the directory.
+        """
+        taskdir = os.path.realpath(self.taskdir)
+        return sorted(
+            entry.name for entry in os.scandir(taskdir)
+            if entry.is_file() and not entry.name.startswith('.')
         )
-        for kind, filename in filemap:
-            path = os.path.join(os.path.realpath(self.taskdir), filename)
-            if os.path.isdir(path):
-                raise IOError("Invalid task file. File is a directory.")
-            if os.path.exists(path):
-                with open(path, 'r') as tfile:
-                    tasklines = [taskline.strip()
-                                 for taskline in tfile if taskline]
-                    tasks = map(_task_from_taskline, tasklines)
-                    for task in tasks:
-                        getattr(self, kind)[task['id']] = task
+
+    def iter_lines(self, jobs=1, **options):
+        """
+        Yield the lines of every list, each led by the name of its list.
+
+        The lists are read and formatted by `TaskDict.iter_list` with the
+        given options, in a pool of `jobs` processes if jobs is more than 1.
+        Output is in order of list name, and in each list in the usual order.
+        Prefixes are unique within each list, so they can be used together
+        with the list name (`tld -l NAME -f PREFIX`).
+
+        With a machine readable output_format, records carry the list name as
+        described in `_encode_tasks`.
+
+        A file which cannot be read as a list (e.g. a binary file, or another
+        text file in the directory) is skipped, with a warning on stderr.
+        """
+        names = self.names()
+        worker = functools.partial(_list_lines, self.taskdir, self.cache,
+                                   self.id_scheme, options)
+        if jobs > 1 and len(names) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                chunksize = max(1, len(names) // (4 * jobs))
+                yield from self._join(names, executor.map(
+                    worker, names, chunksize=chunksize), options)
+        else:
+            yield from self._join(names, map(worker, names), options)
+
+    @staticmethod
+    def _join(names, results, options):
+        """
+        Yield the lines of each list, led by its name.
+
+        results are the (lines, error) pairs returned by `_list_lines`. In a
+        machine readable format, the name is a field of each record instead,
+        and only the first list keeps its header line.
+        """
+        output_format = options.get('output_format', 'human')
+        header = output_format in _HEADED_FORMATS
+        width = max(map(len, names), default=0)
+        first = True
+        for name, (lines, error) in zip(names, results):
+            if error is not None:
+                sys.stderr.write("Skipped {}: {}\n".format(name, error))
+                continue
+            if output_format != 'human':
+                yield from lines[1:] if header and not first else lines
+            else:
+                for line in lines:
+                    yield name.ljust(width) + ': ' + line
+            first = False
+
+    def print_lists(self, jobs=1, **options):
+        """
+        Output every list, as described in `iter_lines`.
+        """
+        _write_lines(self.iter_lines(jobs=jobs, **options))
         return
 
-    def __getitem__(self, prefix):
-        """
-        Return task with given prefix.
 
-        If more than one item found, raise an exception.
-        """
-        matches = list(
-            filter(lambda id_: id_.startswith(prefix), self.tasks.keys())
-        )
-        if matches == 0:
-            raise KeyError("Prefix {} not in tasklist.".format(prefix))
-        if len(matches) > 1:
-            raise IOError("Ambiguous prefix: {}.".format(prefix))
-        return self.tasks[matches[0]]
+def _list_lines(taskdir, cache, id_scheme, options, name):
+    """
+    Return the formatted lines of one list, read under a shared lock, and
+    None; or None and a message if the file cannot be read as a list.
+
+    The lock file is not created, so that no lock files are left next to
+    files which turn out not to be lists. This is a module level function so
+    that it can run in a worker process.
+    """
+    if options.get('output_format', 'human') != 'human':
+        options = dict(options, list_name=name)
+    try:
+        with task_lock(taskdir=taskdir, name=name, exclusive=False,
+                       create=False):
+            taskdict = TaskDict(taskdir=taskdir, name=name, cache=cache,
+                                id_scheme=id_scheme)
+            return list(taskdict.iter_list(**options)), None
+    except (IOError, KeyError, ValueError) as err:
+        return None, "{}: {}".format(type(err).__name__, err)
+
+
+class AsyncTaskDict():
+    """
+    Asyncio interface to a TaskDict, for use inside services.
+
+    Reading and writing the task files is done in a thread pool (executor, or
+    the event loop's default), so the event loop is never blocked on disk.
+    Mutations are applied in memory, one at a time, and never while a write is
+    in progress. In journal mode, where each mutation is also appended to the
+    journal, mutations run in the thread pool too.
+
+    Every call to `write` made while the event loop runs the same tick shares
+    a single flush to disk, so many concurrent requests cost one write. The
+    flush holds the list's `task_lock`, so it does not interleave with other
+    processes writing the same list. If another process changed the task
+    files since they were read (or last written here), the flush raises an
+    IOError rather than overwrite those changes; `load` reads them again.
+
+        taskdict = AsyncTaskDict(taskdir='~/notes/tasks')
+        await taskdict.load()
+        await taskdict.add_task("Buy milk.")
+        await taskdict.write()
+    """
+    # pylint complains about the number of arguments, but these are the
+    # arguments of TaskDict together with the executor.
+    def __init__(self,              # pylint: disable=too-many-arguments
+                 taskdir='.', name='tasks', cache=False, executor=None,
+                 journal=False, fsync='write', id_scheme='sha1',
+                 rotate_done=False):
+        self.taskdir = taskdir
+        self.name = name
+        self.cache = cache
+        self.executor = executor
+        self.journal = journal
+        self.fsync = fsync
+        self.id_scheme = id_scheme
+        self.rotate_done = rotate_done
+        # The TaskDict, once loaded.
+        self.taskdict = None
+        self._lock = None
+        # The future shared by the writes waiting for the next flush.
+        self._pending = None
+        self._delete_if_empty = False
+        # The signatures of the task files as last read or written here.
+        self._signatures = None
+
+    async def load(self):
+        """
+        Read the task files.
+        """
+        import asyncio
+        self._lock = asyncio.Lock()
+        loop = _running_loop()
+        self.taskdict, self._signatures = await loop.run_in_executor(
+            self.executor, self._read_locked)
+        return
+
+    def _read_locked(self):
+        """
+        Read the task files under a shared lock, and return the TaskDict and
+        the signatures of the files.
+        """
+        with task_lock(taskdir=self.taskdir, name=self.name,
+                       exclusive=False):
+            taskdict = TaskDict(taskdir=self.taskdir, name=self.name,
+                                cache=self.cache, journal=self.journal,
+                                fsync=self.fsync, id_scheme=self.id_scheme,
+                                rotate_done=self.rotate_done)
+            return taskdict, taskdict.file_signatures()
+
+    def _locked(self, call):
+        """
+        Return call() made while holding the list's lock.
+
+        Raise an IOError instead if the task files were changed by another
+        process since they were read or last written here, as call might
+        overwrite those changes.
+        """
+        with task_lock(taskdir=self.taskdir, name=self.name):
+            if self.taskdict.file_signatures() != self._signatures:
+                raise IOError("The list {} was changed by another process "
+                              "since it was read.".format(self.name))
+            try:
+                return call()
+            finally:
+                self._signatures = self.taskdict.file_signatures()
+
+    async def _mutate(self, method, *args, **kwargs):
+        """
+        Call a TaskDict method once no write is in progress, and return its
+        result.
+        """
+        call = functools.partial(getattr(self.taskdict, method), *args,
+                                 **kwargs)
+        async with self._lock:
+            if self.journal:
+                return await _running_loop().run_in_executor(
+                    self.executor, self._locked, call)
+            return call()
+
+    async def add_task(self, text, tags=(), dated=False):
+        """
+        Create a task with associated text.
+        """
+        await self._mutate('add_task', text, tags=tags, dated=dated)
+        return
+
+    async def edit_task(self, prefix, text, tags=()):
+        """
+        Edit the task with given prefix to contain given text, and return
+        the new id of the task.
+        """
+        return await self._mutate('edit_task', prefix, text, tags=tags)
+
+    async def finish_task(self, prefix):
+        """
+        Remove a task with associated prefix and mark it `done`.
+        """
+        await self._mutate('finish_task', prefix)
+        return
+
+    async def remove_task(self, prefix):
+        """
+        Remove a task with associated prefix (without adding it to `done`).
+        """
+        await self._mutate('remove_task', prefix)
+        return
+
+    async def delete_finished(self):
+        """
+        Clears the 'done' list (and file) of tasks.
+        """
+        await self._mutate('delete_finished')
+        return
+
+    async def write(self, delete_if_empty=False):
+        """
+        Save the tasklist, together with every other write in this tick.
+        """
+        import asyncio
+        self._delete_if_empty = self._delete_if_empty or delete_if_empty
+        if self._pending is None:
+            loop = _running_loop()
+            self._pending = loop.create_future()
+            loop.call_soon(self._start_flush)
+        await asyncio.shield(self._pending)
+        return
+
+    def _start_flush(self):
+        """
+        Flush the writes requested so far, in a task of its own.
+        """
+        import asyncio
+        future, self._pending = self._pending, None
+        delete_if_empty, self._delete_if_empty = self._delete_if_empty, False
+        asyncio.ensure_future(self._flush(future, delete_if_empty))
+        return
+
+    async def _flush(self, future, delete_if_empty):
+        """
+        Write the task files in the executor and resolve future.
+        """
+        loop = _running_loop()
+        async with self._lock:
+            try:
+                await loop.run_in_executor(self.executor, self._write_locked,
+                                           delete_if_empty)
+            except Exception as err:    # pylint: disable=broad-except
+                future.set_exception(err)
+            else:
+                future.set_result(None)
+        return
+
+    def _write_locked(self, delete_if_empty):
+        """
+        Write the task files while holding the list's lock, as in `_locked`.
+        """
+        self._locked(functools.partial(self.taskdict.write, delete_if_empty))
+        return
+
+
+def _running_loop():
+    """
+    Return the running event loop.
+
+    asyncio.get_running_loop is new in Python 3.7. Before that, inside a
+    coroutine, get_event_loop returns the running loop.
+    """
+    import asyncio
+    return getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+
+
+class Task(collections.abc.MutableMapping):
+    """
+    A single task.
+
+    The id, text, tags and date of a task are stored in typed slots, and any
+    other metadata in the `extra` dictionary (None if there is none). This
+    takes far less memory than a dictionary per task.
+
+    A Task can also be used as the dictionary
+
+        {
+          'id': <hash_id>,
+          'text': <summary_text>,
+          'tags': <comma separated tags>,
+          'date': <datetime.date>,
+          ... other metadata ...
+        }
+
+    where 'tags' and 'date' are only present if set. Metadata is written to
+    task files in this order, so reading and writing a file doesn't change it.
+    """
+    __slots__ = ('id', 'text', 'tags', 'date', 'extra')
+
+    # pylint complains about the number of arguments, but these are exactly
+    # the fields of a task.
+    def __init__(self,              # pylint: disable=too-many-arguments
+                 id_, text, tags=(), date=None, extra=None):
+        self.id = id_               # pylint: disable=invalid-name
+        self.text = text
+        # A tuple of tags.
+        self.tags = tags
+        # A datetime.date, or the original string if it was not an ISO date.
+        self.date = date
+        self.extra = extra
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Build a task from the tuple returned by `to_record`.
+        """
+        id_, text, tags, date, extra = record
+        return cls(id_, text, tags, _parse_date(date) if date else None, extra)
+
+    def to_record(self):
+        """
+        Return the task as a tuple of builtin types, suitable for marshal.
+        """
+        date = None if self.date is None else str(self.date)
+        return (self.id, self.text, self.tags, date, self.extra)
+
+    def __getitem__(self, key):
+        if key == 'id':
+            return self.id
+        if key == 'text':
+            return self.text
+        if key == 'tags' and self.tags:
+            return ','.join(self.tags)
+        if key == 'date' and self.date is not None:
+            return self.date
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'id':
+            self.id = value
+        elif key == 'text':
+            self.text = value
+        elif key == 'tags':
+            self.tags = tuple(value.split(',')) if value else ()
+        elif key == 'date':
+            self.date = _parse_date(value) if isinstance(value, str) else value
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key == 'tags' and self.tags:
+            self.tags = ()
+        elif key == 'date' and self.date is not None:
+            self.date = None
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        yield 'id'
+        yield 'text'
+        if self.tags:
+            yield 'tags'
+        if self.date is not None:
+            yield 'date'
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return (2 + bool(self.tags) + (self.date is not None)
+                + len(self.extra or ()))
+
+    def __repr__(self):
+        return 'Task({!r})'.format(dict(self.items()))
+
+
+class _TermIndex():
+    """
+    Inverted index of the words and tags of a collection of tasks.
+
+    The words of a task are the runs of letters, digits and underscores in its
+    text. Words and tags are both matched whole, ignoring case, so the tag
+    `foo` does not match a task tagged `foobar`.
+
+    The tasks with a date are also kept sorted by date, for `dated`.
+    """
+    def __init__(self, tasks):
+        self.words = {}
+        self.tags = {}
+        dated = []
+        for id_, task in tasks.items():
+            for word in _words(task.text):
+                self.words.setdefault(word, set()).add(id_)
+            for tag in task.tags:
+                self.tags.setdefault(tag.lower(), set()).add(id_)
+            if task.date is not None and not isinstance(task.date, str):
+                dated.append((task.date, id_))
+        dated.sort()
+        self.dates = [date for date, _ in dated]
+        self.date_ids = [id_ for _, id_ in dated]
+
+    def lookup(self, words=None, tags=None, match_any=False):
+        """
+        Return the set of ids having all of the words and tags, or any of
+        them if match_any is True.
+
+        Each string in words can hold several words. Return None if there
+        are no words or tags to look up.
+        """
+        postings = [self.words.get(word, set())
+                    for phrase in words or () for word in _words(phrase)]
+        postings.extend(self.tags.get(tag.lower(), set())
+                        for tag in tags or () if tag)
+        if not postings:
+            return None
+        if match_any:
+            return set().union(*postings)
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def dated(self, operator_, date):
+        """
+        Return the set of ids of the tasks whose date compares to the
+        datetime.date date by operator_, one of '=', '!=', '<', '<=', '>' and
+        '>='. Tasks without a date (or with one not in ISO format) are never
+        returned.
+        """
+        left = bisect.bisect_left(self.dates, date)
+        right = bisect.bisect_right(self.dates, date)
+        ids = self.date_ids
+        if operator_ == '=':
+            return set(ids[left:right])
+        if operator_ == '!=':
+            return set(ids[:left]).union(ids[right:])
+        if operator_ == '<':
+            return set(ids[:left])
+        if operator_ == '<=':
+            return set(ids[:right])
+        if operator_ == '>':
+            return set(ids[right:])
+        return set(ids[left:])
+
+
+class _ArchiveFile():
+    """
+    Index of the ids of the lines of a done file or done segment.
+
+    An uncompressed file is memory mapped, and a compressed one (ending in
+    '.gz' or '.xz') is decompressed into memory. Only the id and the end of
+    each line are found, with one regular expression over the bytes. A task
+    is decoded from its line when it is looked up.
+
+    A ValueError is raised if a line of the file has no id, as its id could
+    only be found by decoding and hashing it.
+    """
+    # A line whose metadata (the part after its last '|') has an id, as a
+    # piece of its own: right after the '|' or a ';'.
+    _LINE = None
+
+    def __init__(self, path):
+        import re
+        if _ArchiveFile._LINE is None:
+            _ArchiveFile._LINE = re.compile(
+                rb'[^\n]*\|(?:[^\n|]*;)?[ \t]*id:[ \t]*([^;\s|]+)[^\n|]*'
+                rb'(?:\n|\Z)')
+        # The end of each line, and its id, in file order.
+        self.ends = []
+        self.line_ids = []
+        # The end of the last line of each id.
+        self.end_of = {}
+        self.data = _read_archive_bytes(path)
+        end = 0
+        for match in _ArchiveFile._LINE.finditer(self.data):
+            if match.start() != end and self.data[end:match.start()].strip():
+                raise ValueError("Line without id in {}.".format(path))
+            end = match.end()
+            id_ = match.group(1).decode('utf-8')
+            self.ends.append(end)
+            self.line_ids.append(id_)
+            self.end_of[id_] = end
+        if self.data[end:].strip():
+            raise ValueError("Line without id in {}.".format(path))
+
+    def __contains__(self, id_):
+        return id_ in self.end_of
+
+    def __iter__(self):
+        return iter(self.end_of)
+
+    def __getitem__(self, id_):
+        end = self.end_of[id_]
+        start = self.data.rfind(b'\n', 0, end - 1) + 1
+        return _task_from_taskline(self.data[start:end].decode('utf-8'))
+
+    def search(self, pattern):
+        """
+        Return the ids of the lines in which the bytes pattern is found.
+        """
+        ids = set()
+        for match in pattern.finditer(self.data):
+            line = bisect.bisect_right(self.ends, match.start())
+            if line < len(self.line_ids):
+                ids.add(self.line_ids[line])
+        return ids
+
+
+def _read_archive_bytes(path):
+    """
+    Return the content of a done file or segment, as bytes or a memory map.
+    """
+    if path.endswith('.gz'):
+        import gzip
+        with gzip.open(path, 'rb') as afile:
+            return afile.read()
+    if path.endswith('.xz'):
+        import lzma
+        with lzma.open(path, 'rb') as afile:
+            return afile.read()
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return b''
+    import mmap
+    with open(path, 'rb') as afile:
+        return mmap.mmap(afile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _Archive(collections.abc.Mapping):
+    """
+    Read-only view of several collections of done tasks as one mapping from
+    ids to tasks.
+
+    layers are dictionaries of tasks or `_ArchiveFile`s, newest first. A task
+    in a layer hides any task with the same id in the layers after it.
+    """
+    def __init__(self, layers):
+        self.layers = layers
+
+    def __getitem__(self, id_):
+        for layer in self.layers:
+            if id_ in layer:
+                return layer[id_]
+        raise KeyError(id_)
+
+    def __iter__(self):
+        seen = set()
+        for layer in self.layers:
+            for id_ in layer:
+                if id_ not in seen:
+                    seen.add(id_)
+                    yield id_
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def search(self, grep_string, regex=False, match_any=False):
+        """
+        Return the ids of the tasks whose lines might match the grep terms.
+
+        The terms are searched for in the bytes of each file, ignoring ASCII
+        case, so the ids returned include those of all tasks matching as in
+        `_compile_matcher`, and perhaps others. Return None if the terms
+        cannot be searched for in bytes (e.g. they are not ASCII).
+
+        Regular expressions are not searched for, as they may be anchored to
+        the ends of the task text (which are not the ends of its line), or
+        otherwise depend on the text rather than the line. Return None for
+        them too.
+        """
+        import re
+        if regex:
+            return None
+        if isinstance(grep_string, str):
+            grep_string = [grep_string]
+        found = []
+        for term in grep_string or ():
+            if not term:
+                continue
+            try:
+                term = term.encode('ascii')
+                pattern = re.compile(re.escape(term), re.IGNORECASE)
+            except (UnicodeEncodeError, re.error):
+                return None
+            ids = set()
+            for layer in self.layers:
+                if isinstance(layer, _ArchiveFile):
+                    ids.update(layer.search(pattern))
+                else:
+                    ids.update(layer)
+            found.append(ids)
+        if not found:
+            return None
+        if match_any:
+            return set().union(*found)
+        return found[0].intersection(*found[1:])
+
+
+# Sort keys of the orders in SORT_ORDERS other than 'id'. Tasks without a date
+# or tags come last.
+_SORT_KEYS = {
+    'date': lambda task: (task.date is None, str(task.date)),
+    'text': lambda task: task.text.lower(),
+    'tag': lambda task: (not task.tags, ','.join(task.tags).lower()),
+}
+
+
+def _page(ids, tasks, sort='id', limit=None, offset=0):
+    """
+    Return the ids of a page of tasks, in the order sort (one of SORT_ORDERS).
+
+    ids is a sorted list of ids of tasks. The page skips the first offset of
+    them, and has at most limit of them (or all the rest if limit is None).
+    Ties are ordered by id. With a limit, the page is chosen with a heap of
+    offset + limit tasks rather than by sorting all of them.
+    """
+    end = None if limit is None else offset + limit
+    if sort == 'id':
+        return ids[offset:end]
+    key = _SORT_KEYS[sort]
+    keyed = ((key(tasks[id_]), id_) for id_ in ids)
+    if end is None:
+        ordered = sorted(keyed)
+    else:
+        import heapq
+        ordered = heapq.nsmallest(end, keyed)
+    return [id_ for _, id_ in ordered[offset:]]
+
+
+def _words(text):
+    """
+    Return the lowercased words of text.
+    """
+    import re
+    return re.findall(r'\w+', text.lower())
+
 
-    def add_task(self, text, tags=(), dated=False):
+class _IdIndex():
+    """
+    Sorted index of task ids, supporting lookup by prefix.
+
+    All ids starting with a given prefix are adjacent in sorted order, so a
+    prefix lookup is a binary search followed by a comparison with the next id.
+    """
+    def __init__(self, ids=(), presorted=False):
+        self.ids = list(ids) if presorted else sorted(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id_):
         """
-        Create a task with associated text.
+        Insert id_ into the index, if it is not already present.
         """
-        id_ = _hash(text)
-        self.tasks[id_] = {'id': id_, 'text': text}
-        if tags:
-            self.tasks[id_]['tags'] = ','.join(tag for tag in tags)
-        if dated:
-            self.tasks[id_]['date'] = datetime.date.today()
+        i = bisect.bisect_left(self.ids, id_)
+        if i == len(self.ids) or self.ids[i] != id_:
+            self.ids.insert(i, id_)
         return
 
-    def delete_finished(self):
+    def discard(self, id_):
         """
-        Clears the 'done' list (and file) of tasks.
+        Remove id_ from the index, if it is present.
         """
-        self.done = {}
+        i = bisect.bisect_left(self.ids, id_)
+        if i < len(self.ids) and self.ids[i] == id_:
+            del self.ids[i]
         return
 
-    def edit_task(self, prefix, text, tags=()):
+    def find(self, prefix):
         """
-        Edit the task with given prefix to contain given text.
+        Return the unique id starting with prefix.
 
-        Allow also perl-style `s/old/new` replacements on text.
+        Raise a KeyError if no id has this prefix, and an IOError if more than
+        one id does.
         """
-        task = self[prefix]
-        # Allow perl-style s/old/new replacement
-        if text.startswith('s/'):
-            text = text[2:].strip('/')
-            find, _, repl = text.partition('/')
-            if not repl:
-                raise IOError("perl-string {} malformed.".format('s/' + text))
-            text = re.sub(find, repl, task['text'])
-        task['text'] = text
-        task['id'] = _hash(text)
-        if tags:
-            task['tags'] = ','.join(tags)
-        return
+        i = bisect.bisect_left(self.ids, prefix)
+        if i == len(self.ids) or not self.ids[i].startswith(prefix):
+            raise KeyError("Prefix {} not in tasklist.".format(prefix))
+        if self.ids[i] == prefix:
+            return prefix
+        if i + 1 < len(self.ids) and self.ids[i + 1].startswith(prefix):
+            raise IOError("Ambiguous prefix: {}.".format(prefix))
+        return self.ids[i]
 
-    def finish_task(self, prefix):
+
+def _batch_summary(task):
+    """
+    Describe a task in a line of a batch summary.
+    """
+    return "{} - {}".format(task.id[:7], task.text)
+
+
+def _compile_matcher(grep_string, regex=False, match_any=False):
+    """
+    Return a function testing whether a task matches the grep terms.
+
+    grep_string is a single term or a list of terms. A task matches a term if
+    its text or tags contain it, ignoring case. If regex is True, the terms are
+    regular expressions instead of plain substrings. A task must match all of
+    the terms, or any of them if match_any is True.
+
+    Return None if there are no terms, so that callers can skip filtering.
+    """
+    if isinstance(grep_string, str):
+        grep_string = [grep_string]
+    terms = [term for term in grep_string or () if term]
+    if not terms:
+        return None
+    import re
+    if not regex:
+        terms = [re.escape(term) for term in terms]
+    if match_any:
+        terms = ['|'.join('(?:{})'.format(term) for term in terms)]
+    patterns = [re.compile(term, re.IGNORECASE).search for term in terms]
+
+    def matcher(task):
+        text = task['text']
+        tags = task.get('tags', '')
+        for search in patterns:
+            if not search(text) and not (tags and search(tags)):
+                return False
+        return True
+    return matcher
+
+
+class _Query():
+    """
+    A compiled query, as returned by `_compile_query`.
+
+    test(task) is True if the task matches the query. If indexed is True,
+    lookup(index) returns, from a `_TermIndex`, a set of ids containing those
+    of every matching task, so that only these need to be tested. Otherwise
+    every task must be tested.
+    """
+    def __init__(self, test, lookup=None):
+        self.test = test
+        self.lookup = lookup
+        self.indexed = lookup is not None
+
+
+class _QueryParser():
+    """
+    Recursive descent parser of the query language described in
+    `_compile_query`.
+    """
+    # A parenthesis, a term 'field op value', or a bare word.
+    _TOKEN = None
+
+    # The comparisons of dates.
+    _COMPARISONS = {
+        '=': operator.eq, '!=': operator.ne,
+        '<': operator.lt, '<=': operator.le,
+        '>': operator.gt, '>=': operator.ge,
+    }
+
+    def __init__(self, query):
+        import re
+        if _QueryParser._TOKEN is None:
+            _QueryParser._TOKEN = re.compile(
+                r'\s*(?:(?P<paren>[()])'
+                r'|(?P<field>[A-Za-z]+)(?P<op><=|>=|!=|[:~<>=])'
+                r'(?P<value>"(?:[^"\\]|\\.)*"|/(?:[^/\\]|\\.)*/|[^\s()]+)'
+                r'|(?P<word>[^\s()]+))')
+        self.tokens = []
+        pos = 0
+        query = query.rstrip()
+        while pos < len(query):
+            match = _QueryParser._TOKEN.match(query, pos)
+            if match is None:
+                raise ValueError("Cannot parse query at {!r}.".format(
+                    query[pos:]))
+            self.tokens.append(match)
+            pos = match.end()
+        self.pos = 0
+
+    def parse(self):
         """
-        Remove a task with associated prefix and mark it `done`.
+        Return the `_Query` of the whole query.
         """
-        task = self.tasks.pop(self[prefix]['id'])
-        self.done[task['id']] = task
-        return
-
-    def remove_task(self, prefix):
+        if not self.tokens:
+            raise ValueError("Empty query.")
+        query = self._or()
+        if self.pos < len(self.tokens):
+            raise ValueError("Unexpected {!r} in query.".format(
+                self.tokens[self.pos].group().strip()))
+        return query
+
+    def _accept(self, keyword):
         """
-        Remove a task with associated prefix (without adding it to `done`).
+        Consume the next token and return True if it is the bare word
+        keyword (ignoring case) or the parenthesis keyword.
         """
-        self.tasks.pop(self[prefix]['id'])
-        return
-
-    def write(self, delete_if_empty=False):
+        if self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            text = token.group('word') or token.group('paren') or ''
+            if text.lower() == keyword:
+                self.pos += 1
+                return True
+        return False
+
+    def _starts_term(self):
         """
-        Saves tasklist.
+        Return True if the next token starts a term, which is then joined to
+        the term before it by an implicit `and`.
         """
-        filemap = (
-            ('tasks', self.name),
-            ('done', '.{}.done'.format(self.name)),
-        )
-        for kind, filename in filemap:
-            path = os.path.join(os.path.realpath(self.taskdir), filename)
-            if os.path.isdir(path):
-                raise IOError("Invalid task file. File is a directory.")
-            tasks = sorted(getattr(self, kind).values(),
-                           key=operator.itemgetter('id'))
-            if tasks or not delete_if_empty:
-                with open(path, 'w') as tfile:
-                    for taskline in _tasklines_from_tasks(tasks):
-                        tfile.write(taskline)
-            elif not tasks and os.path.isfile(path):
-                os.remove(path)
-        return
-
-    # pylint complains about this method having too many arguments. But as the
-    # arguments are clear and have sane defaults, I simply disable the warning.
-    # It would also be possible to pass in the options datastructure directly,
-    # but that would lengthen the control logic in this function.
-    def print_list(self,            # pylint: disable=too-many-arguments
-                   kind='tasks',
-                   quiet=False,
-                   grep_string='',
-                   showtags=False,
-                   showdates=False,
-                   longname=False):
+        if self.pos >= len(self.tokens):
+            return False
+        token = self.tokens[self.pos]
+        if token.group('word') is not None:
+            return token.group('word').lower() not in ('and', 'or')
+        return token.group('paren') != ')'
+
+    def _or(self):
+        operands = [self._and()]
+        while self._accept('or'):
+            operands.append(self._and())
+        if len(operands) == 1:
+            return operands[0]
+        tests = [operand.test for operand in operands]
+        lookup = None
+        if all(operand.indexed for operand in operands):
+            def lookup(index):
+                return set().union(*(operand.lookup(index)
+                                     for operand in operands))
+        return _Query(lambda task: any(test(task) for test in tests), lookup)
+
+    def _and(self):
+        operands = [self._not()]
+        while self._accept('and') or self._starts_term():
+            operands.append(self._not())
+        if len(operands) == 1:
+            return operands[0]
+        tests = [operand.test for operand in operands]
+        indexed = [operand for operand in operands if operand.indexed]
+        lookup = None
+        if indexed:
+            def lookup(index):
+                postings = sorted((operand.lookup(index)
+                                   for operand in indexed), key=len)
+                return postings[0].intersection(*postings[1:])
+        return _Query(lambda task: all(test(task) for test in tests), lookup)
+
+    def _not(self):
+        if self._accept('not'):
+            test = self._not().test
+            return _Query(lambda task: not test(task))
+        return self._atom()
+
+    def _atom(self):
+        if self._accept('('):
+            query = self._or()
+            if not self._accept(')'):
+                raise ValueError("Missing ')' in query.")
+            return query
+        if self.pos >= len(self.tokens):
+            raise ValueError("Query ends too early.")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        if token.group('word') is not None:
+            word = token.group('word')
+            if word.lower() in ('and', 'or', 'not'):
+                raise ValueError("Unexpected {!r} in query.".format(word))
+            return self._term('text', ':', word)
+        if token.group('paren') is not None:
+            raise ValueError("Unexpected ')' in query.")
+        return self._term(token.group('field').lower(), token.group('op'),
+                          token.group('value'))
+
+    def _term(self, field, operator_, value):
         """
-        Output tasklist.
+        Return the `_Query` of a single term.
         """
-        tasks = dict(getattr(self, kind).items())
-        minsize = 6 if longname else 0
-        set_task_prefixes(tasks, minsize=minsize)
-        plen = max(
-            map(lambda t: len(t['prefix']), tasks.values())
-        ) if tasks else 0
-        if showdates:
-            dlen = max(
-                map(lambda t: len(t.get('date', '')), tasks.values())
-            ) if tasks else 0
-        task_values = list(tasks.values())
-        task_values.sort(key=operator.itemgetter('id'))
-        for taskval in task_values:
-            tags = taskval.get('tags', '')
-            if (grep_string.lower() not in taskval['text'].lower()
-                    and not grep_string.lower() in tags):
-                continue
-            if showdates:
-                start = taskval.get('date', '')
-                start = start.ljust(dlen)
-                if dlen:
-                    start += ' | '
-            else:
-                start = ''
-            if not quiet:
-                start += '{} - '.format(taskval['prefix'].ljust(plen))
-            report = start + taskval['text']
-            if showtags and tags:
-                report += ' | tags: ' + ', '.join(tags.split(','))
-            print(report)
-        return
+        import re
+        if value[0] == value[-1] == '/' and len(value) > 1:
+            if operator_ != '~':
+                raise ValueError("Use ~ to match {}.".format(value))
+            try:
+                pattern = re.compile(value[1:-1].replace('\\/', '/'),
+                                     re.IGNORECASE)
+            except re.error as err:
+                raise ValueError("Bad regular expression {}: {}.".format(
+                    value, err))
+            value = None
+        elif value[0] == value[-1] == '"' and len(value) > 1:
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        if operator_ == '~':
+            if value is not None:
+                pattern = re.compile(re.escape(value), re.IGNORECASE)
+            return self._search(field, pattern.search)
+        if field == 'tag' and operator_ in (':', '='):
+            tag = value.lower()
+            return _Query(
+                lambda task: tag in task.get('tags', '').lower().split(','),
+                lambda index: index.tags.get(tag, set()))
+        if field == 'text' and operator_ == ':':
+            value = value.lower()
+            return _Query(lambda task: value in task['text'].lower())
+        if field == 'id' and operator_ == ':':
+            return _Query(lambda task: task['id'].startswith(value))
+        if field == 'date' and (operator_ == ':'
+                                or operator_ in self._COMPARISONS):
+            return self._date('=' if operator_ == ':' else operator_, value)
+        raise ValueError("Unknown query term {}{}{}.".format(
+            field, operator_, value))
+
+    @staticmethod
+    def _search(field, search):
+        """
+        Return the `_Query` of field~/regex/.
+        """
+        if field == 'text':
+            return _Query(lambda task: search(task['text']) is not None)
+        if field == 'tag':
+            return _Query(lambda task: any(
+                search(tag) for tag in task.get('tags', '').split(',')
+                if tag))
+        if field == 'id':
+            return _Query(lambda task: search(task['id']) is not None)
+        raise ValueError("Cannot match {} with ~.".format(field))
+
+    def _date(self, operator_, value):
+        """
+        Return the `_Query` comparing the date of a task with value.
+        """
+        date = _parse_date(value)
+        if isinstance(date, str):
+            raise ValueError("{} is not a date in YYYY-MM-DD format.".format(
+                value))
+        compare = self._COMPARISONS[operator_]
+
+        def test(task):
+            task_date = task.get('date')
+            if task_date is None or isinstance(task_date, str):
+                return False
+            return compare(task_date, date)
+        return _Query(test, lambda index: index.dated(operator_, date))
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_query(query):
+    """
+    Return the `_Query` of a query string, raising a ValueError if it is not
+    well formed.
+
+    A query is made of terms joined by `and`, `or` and `not` (in increasing
+    order of precedence) and grouped by parentheses. Terms written next to
+    each other are joined by `and`. The terms are
+
+        tag:NAME        the task has the tag NAME, ignoring case
+        text:WORDS      the text contains WORDS, ignoring case
+        id:PREFIX       the id starts with PREFIX
+        date=DATE       the date compares to DATE, given as YYYY-MM-DD; the
+                        comparisons are = (or :), !=, <, <=, > and >=
+        FIELD~/REGEX/   the text, a tag or the id matches REGEX, ignoring
+                        case
+        FIELD~STRING    the field contains STRING, ignoring case
+        WORD            the same as text:WORD
+
+    A value may be written in double quotes to include spaces or
+    parentheses. Tasks without a date match no date comparison. For example,
+
+        tag:work and date>=2026-01-01 and not text~/draft/
+
+    Queries are cached, so a query used for many lists is compiled once.
+    """
+    return _QueryParser(query).parse()
+
+
+def _both(first, second):
+    """
+    Return a function testing whether a task passes both tests.
+    """
+    return lambda task: first(task) and second(task)
+
+
+# The fields of a task in the machine readable output formats, in order.
+TASK_FIELDS = ('id', 'prefix', 'text', 'tags', 'date')
+
+# The output formats which start with a header line naming the fields.
+_HEADED_FORMATS = ('tsv', 'csv')
 
 
-def set_task_prefixes(tasks, minsize=0):
+def _encode_tasks(tasks, output_format, list_name=None):
     """
-    Assign computed prefixes to tasks.
+    Yield the lines encoding each (prefix, task) pair of tasks.
+
+    output_format is one of the machine readable OUTPUT_FORMATS:
+
+        jsonl   a JSON object per task, with tags as a list and the date as
+                a string (or null)
+        tsv     tab separated fields, with backslashes, tabs and newlines
+                escaped by a backslash, as in C
+        csv     comma separated fields, quoted as needed
+
+    The fields are TASK_FIELDS, led by 'list' if list_name is given. tsv and
+    csv start with a header line of the field names. Tags are joined by
+    commas in tsv and csv, and a missing date is empty.
+
+    Each line is encoded as it is needed, so a list of any length takes
+    constant memory.
+    """
+    fields = TASK_FIELDS if list_name is None else ('list',) + TASK_FIELDS
+    lead = () if list_name is None else (list_name,)
+    if output_format == 'jsonl':
+        import json
+        for prefix, task in tasks:
+            tags = task.get('tags')
+            date = task.get('date')
+            values = lead + (task['id'], prefix, task['text'],
+                             tags.split(',') if tags else [],
+                             None if date is None else str(date))
+            yield json.dumps(dict(zip(fields, values)),
+                             ensure_ascii=False) + '\n'
+    elif output_format == 'tsv':
+        yield '\t'.join(fields) + '\n'
+        for prefix, task in tasks:
+            values = lead + (task['id'], prefix, task['text'],
+                             task.get('tags', ''), str(task.get('date', '')))
+            yield '\t'.join(map(_escape_tsv, values)) + '\n'
+    elif output_format == 'csv':
+        import csv
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(fields)
+        yield buf.getvalue()
+        for prefix, task in tasks:
+            buf.seek(0)
+            buf.truncate()
+            writer.writerow(lead + (task['id'], prefix, task['text'],
+                                    task.get('tags', ''),
+                                    str(task.get('date', ''))))
+            yield buf.getvalue()
+    else:
+        raise ValueError("Unknown output format {}.".format(output_format))
+    return
+
+
+def _escape_tsv(value):
+    """
+    Escape backslashes, tabs and newlines in a field of tsv output.
+    """
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _write_lines(lines, chunk_size=OUTPUT_CHUNK_SIZE):
+    """
+    Write lines to stdout, `chunk_size` lines at a time.
+
+    Stop quietly if the reading end of a pipe is closed.
     """
-    for id_, prefix in _prefixes(tasks, minsize=minsize).items():
-        tasks[id_]['prefix'] = prefix
+    out = sys.stdout
+    chunk = []
+    try:
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                out.write(''.join(chunk))
+                out.flush()
+                chunk = []
+        out.write(''.join(chunk))
+        out.flush()
+    except BrokenPipeError:
+        # Python flushes stdout again on exit, which would fail in the same
+        # way. Point stdout at devnull so that this exits quietly.
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, out.fileno())
+        except (AttributeError, OSError, ValueError):
+            pass
     return
 
 
@@ -288,6 +2415,7 @@ def _build_parser():
     """
     Create the command line parser.
     """
+    import argparse
     usage = "Usage: %(prog)s [-t DIR] [-l LIST] [options] [TEXT]"
     epilog = (
         "Author: David Lowry-Duda <david@lowryduda.com>."
@@ -316,6 +2444,18 @@ def _build_parser():
                          dest="delete_finished",
                          action="store_true", default=False,
                          help="delete finished items to save space")
+    actions.add_argument("--batch",
+                         dest="batch",
+                         help=("apply the commands in FILE ('-' for stdin), "
+                               "one per line: '-f TASK', '-r TASK', "
+                               "'-e TASK TEXT', or a task line to add"),
+                         metavar="FILE")
+    actions.add_argument("--compress-done",
+                         dest="compress_done",
+                         choices=sorted(DONE_COMPRESSION),
+                         help=("compress the older segments of the done list "
+                               "with METHOD (gzip or lzma)"),
+                         metavar="METHOD")
 
     entry = parser.add_argument_group("Entry Options")
     entry.add_argument("--tag",
@@ -344,8 +2484,82 @@ def _build_parser():
                         dest="delete_if_empty",
                         action="store_true", default=False,
                         help="delete the task file if it becomes empty")
+    config.add_argument("--lock-timeout",
+                        dest="lock_timeout",
+                        type=float, default=None,
+                        help=("give up if the list is still locked by another "
+                              "tld after SECONDS (default: wait)"),
+                        metavar="SECONDS")
+    config.add_argument("--cache",
+                        dest="cache",
+                        action="store_true", default=False,
+                        help=("keep a parsed index next to each task file "
+                              "to speed up reading large lists"))
+    config.add_argument("--id-scheme",
+                        dest="id_scheme", default="sha1",
+                        choices=ID_SCHEMES,
+                        help=("how ids of new tasks are made: sha1, or the "
+                              "shorter and faster blake2b or short "
+                              "(default: sha1)"))
+    config.add_argument("--rotate-done",
+                        dest="rotate_done",
+                        action="store_true", default=False,
+                        help=("move done tasks to monthly segments, keeping "
+                              "the done file small"))
+    config.add_argument("--journal",
+                        dest="journal",
+                        action="store_true", default=False,
+                        help=("record changes in a journal, and only rewrite "
+                              "the task files once it grows large"))
+    config.add_argument("--fsync",
+                        dest="fsync", default="write",
+                        choices=JOURNAL_FSYNC_POLICIES,
+                        help=("when to sync the journal to disk "
+                              "(default: write)"))
+
+    server = parser.add_argument_group(
+        "Server Options",
+        "If the environment variable TLD_SOCKET names the socket of a running "
+        "server, commands are sent to it instead of being run directly."
+    )
+    server.add_argument("--serve",
+                        dest="serve",
+                        action="store_true", default=False,
+                        help=("keep lists in memory and serve commands over a "
+                              "Unix socket until interrupted"))
+    server.add_argument("--socket",
+                        dest="socket", default="",
+                        help=("serve on socket PATH "
+                              "(default: DIR/.tld.sock)"),
+                        metavar="PATH")
+
+    debug = parser.add_argument_group(
+        "Debugging Options",
+        "These can also be turned on by setting the environment variables "
+        "TLD_TIMINGS (to any value but 0) and TLD_PROFILE (to FILE)."
+    )
+    debug.add_argument("--timings",
+                       dest="timings",
+                       action="store_true", default=False,
+                       help=("report the time and peak memory of each phase "
+                             "of the run to stderr"))
+    debug.add_argument("--profile",
+                       dest="profile", default=None,
+                       help="profile the run with cProfile, saving to FILE",
+                       metavar="FILE")
 
     output = parser.add_argument_group("Output Options")
+    output.add_argument("--all-lists",
+                        dest="all_lists",
+                        action="store_true", default=False,
+                        help=("List the tasks of every list in DIR, each line "
+                              "led by the name of its list."))
+    output.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        type=int, default=1,
+                        help=("With --all-lists, read lists in N parallel "
+                              "processes."),
+                        metavar="N")
     output.add_argument("--done",
                         dest='done',
                         action="store_true", default=False,
@@ -356,10 +2570,65 @@ def _build_parser():
                         help="Print less detail (e.g. no task IDs)")
     output.add_argument("-g", "--grep",
                         dest="grep_string",
-                        default='',
+                        action="append",
                         help=("Print only tasks containing WORD. "
-                              "This is case insensitive"),
+                              "This is case insensitive, and can be given "
+                              "more than once"),
+                        metavar="WORD")
+    output.add_argument("--regex",
+                        dest="regex",
+                        action="store_true", default=False,
+                        help="Treat each grep WORD as a regular expression.")
+    output.add_argument("--tag-filter",
+                        dest="tag_filter",
+                        action="append",
+                        help=("Print only tasks tagged exactly TAG. This is "
+                              "case insensitive, and can be given more than "
+                              "once"),
+                        metavar="TAG")
+    output.add_argument("-w", "--word",
+                        dest="words",
+                        action="append",
+                        help=("Print only tasks containing the whole word "
+                              "WORD. This is case insensitive, and can be "
+                              "given more than once"),
                         metavar="WORD")
+    output.add_argument("--any",
+                        dest="match_any",
+                        action="store_true", default=False,
+                        help=("Print tasks matching any grep WORD, or any "
+                              "--tag-filter TAG or --word WORD."))
+    output.add_argument("--all",
+                        dest="match_any",
+                        action="store_false",
+                        help="Print tasks matching every term (default).")
+    output.add_argument("--query",
+                        dest="query", default=None,
+                        type=_query,
+                        help="Print only tasks matching QUERY, such as "
+                             "'tag:work and date>=2026-01-01 and not "
+                             "text~/draft/'.",
+                        metavar="QUERY")
+    output.add_argument("--sort",
+                        dest="sort", default="id",
+                        choices=SORT_ORDERS,
+                        help="List tasks ordered by id (default), date, text "
+                             "or tag.")
+    output.add_argument("--limit",
+                        dest="limit",
+                        type=_count, default=None,
+                        help="List at most N tasks.",
+                        metavar="N")
+    output.add_argument("--offset",
+                        dest="offset",
+                        type=_count, default=0,
+                        help="Skip the first N tasks.",
+                        metavar="N")
+    output.add_argument("--format",
+                        dest="output_format", default="human",
+                        choices=OUTPUT_FORMATS,
+                        help="Print tasks for people (default), or as JSON "
+                             "lines, tab or comma separated values.")
     output.add_argument("--showtags",
                         dest="showtags",
                         action="store_true", default=False,
@@ -375,12 +2644,111 @@ def _build_parser():
     return parser
 
 
-def _hash(text):
+def _query(value):
+    """
+    Check that a command line query compiles, and return it.
+    """
+    import argparse
+    try:
+        _compile_query(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+    return value
+
+
+def _count(value):
+    """
+    Parse a command line count, which must be a non-negative integer.
+    """
+    import argparse
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise argparse.ArgumentTypeError(
+            "{} is not a non-negative integer.".format(value))
+    return count
+
+
+def _atomic_write(path, content, mode='w'):
+    """
+    Replace the file at path with content, atomically.
+
+    The content is written and synced to a temporary file next to the target,
+    which then replaces it. Readers see either the old file or the new one,
+    never a partly written file. The permissions of an existing file, and the
+    file behind a symlink, are kept. The temporary file is hidden, so that it
+    is never taken for a list.
+    """
+    path = os.path.realpath(path)
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(name, os.getpid()))
+    try:
+        with open(tmp_path, mode) as tfile:
+            tfile.write(content)
+            tfile.flush()
+            os.fsync(tfile.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return
+
+
+def _content_hash(content):
+    """
+    Return the SHA1 hash of the text of a task file.
+    """
+    import hashlib
+    return hashlib.sha1(content.encode(encoding='utf-8')).hexdigest()
+
+
+def _read_cache(path, cache_path, id_scheme='sha1'):
+    """
+    Return the sidecar index record for the task file at path.
+
+    Return None if there is no usable index: if it is missing, unreadable, of
+    another version, describes a different version of the task file, or was
+    made with another id scheme than id_scheme (which gives the ids of lines
+    without one).
     """
-    Return the SHA1 hash of the input string.
+    try:
+        with open(cache_path, 'rb') as cfile:
+            record = marshal.load(cfile)
+        stat = os.stat(path)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(record, dict) or record.get('version') != CACHE_VERSION:
+        return None
+    if record['id_scheme'] != id_scheme:
+        return None
+    if record['size'] != stat.st_size:
+        return None
+    if record['mtime'] != stat.st_mtime_ns:
+        # The file was touched, but perhaps not changed.
+        with open(path, 'r') as tfile:
+            if _content_hash(tfile.read()) != record['hash']:
+                return None
+    return record
+
+
+def _hash(text, scheme='sha1'):
     """
+    Return the id of the input string in the given scheme (see ID_SCHEMES).
+    """
+    import hashlib
     bytestring = text.encode(encoding='utf-8')
-    return hashlib.sha1(bytestring).hexdigest()
+    if scheme == 'sha1':
+        return hashlib.sha1(bytestring).hexdigest()
+    if scheme == 'blake2b':
+        return hashlib.blake2b(bytestring, digest_size=10).hexdigest()
+    if scheme == 'short':
+        return hashlib.blake2b(bytestring, digest_size=8).hexdigest()
+    raise ValueError("Unknown id scheme: {}.".format(scheme))
 
 
 def _prefixes(ids, minsize=0):
@@ -389,25 +2757,59 @@ def _prefixes(ids, minsize=0):
 
     Each prefix is the shortest possible substring of the ID that
     uniquely identifies it among the given group of IDs.
+
+    Once the ids are sorted, the ids sharing the longest common prefix with a
+    given id are its immediate neighbors. So it suffices to compare each id
+    with the ids directly before and after it, and the total cost is dominated
+    by the sort.
     """
-    prefixes = {}
-    for id_ in ids:
-        others = set(ids).difference([id_])
-        found = False
-        # iteratively test if id prefix is long enough to be unique
-        for i in range(minsize + 1, len(id_)+1):
-            prefix = id_[:i]
-            # The pf-prefix kwarg silences a pylint cell-var-from-loop warning.
-            # This is safe since prefix is set on the previous line. It would
-            # also work to use id_[:i] directly in loop, but I find that a bit
-            # harder to read.
-            if not any(map(lambda other, pf=prefix: other.startswith(pf), others)):
-                prefixes[id_] = prefix
-                found = True
-                break
-        if not found:
+    return dict(_iter_prefixes(sorted(ids), minsize=minsize))
+
+
+def _iter_prefixes(sorted_ids, minsize=0):
+    """
+    Yield (id, prefix) pairs for an already sorted sequence of ids.
+
+    Raise a KeyError if some id cannot be distinguished from its neighbors,
+    which happens when one id is a prefix of another.
+    """
+    previous_lcp = 0
+    for i, id_ in enumerate(sorted_ids):
+        if i + 1 < len(sorted_ids):
+            next_lcp = _common_prefix_length(id_, sorted_ids[i + 1])
+        else:
+            next_lcp = 0
+        size = max(previous_lcp, next_lcp, minsize) + 1
+        if size > len(id_):
             raise KeyError("Unresolvable hash collision occurred.")
-    return prefixes
+        yield id_, id_[:size]
+        previous_lcp = next_lcp
+
+
+def _prefix_at(sorted_ids, i, minsize=0):
+    """
+    Return the shortest unique prefix of sorted_ids[i] among sorted_ids.
+    """
+    id_ = sorted_ids[i]
+    size = minsize
+    if i > 0:
+        size = max(size, _common_prefix_length(id_, sorted_ids[i - 1]))
+    if i + 1 < len(sorted_ids):
+        size = max(size, _common_prefix_length(id_, sorted_ids[i + 1]))
+    if size + 1 > len(id_):
+        raise KeyError("Unresolvable hash collision occurred.")
+    return id_[:size + 1]
+
+
+def _common_prefix_length(first, second):
+    """
+    Return the length of the longest common prefix of two strings.
+    """
+    size = min(len(first), len(second))
+    for i in range(size):
+        if first[i] != second[i]:
+            return i
+    return size
 
 
 def _tasklines_from_tasks(tasks):
@@ -425,7 +2827,82 @@ def _tasklines_from_tasks(tasks):
     return tasklines
 
 
-def _task_from_taskline(taskline):
+def _parse_date(value):
+    """
+    Return the datetime.date written as YYYY-MM-DD in value.
+
+    Return value itself if it is not a date in that format, so that hand
+    written dates survive being read and written again.
+    """
+    if len(value) == 10 and value[4] == value[7] == '-':
+        import datetime
+        try:
+            return datetime.date(int(value[:4]), int(value[5:7]),
+                                 int(value[8:10]))
+        except ValueError:
+            pass
+    return value
+
+
+def _iter_tasks(content, scheme='sha1'):
+    """
+    Yield the tasks in a task file, in order.
+
+    content is an open task file, or its text. Lines are taken one at a time,
+    from the file or by `_iter_lines`, and each is parsed in place, so no
+    list of the lines is built. Blank lines are skipped. See
+    `_task_from_taskline` for the format of each line. Lines without an id
+    are given one in the id scheme `scheme`.
+    """
+    if isinstance(content, str):
+        content = _iter_lines(content)
+    for line in content:
+        text, sep, meta = line.rpartition('|')
+        if not sep:
+            text = meta.strip()
+            if text:
+                yield Task(_hash(text, scheme), text)
+            continue
+        text = text.strip()
+        id_ = None
+        tags = ()
+        date = extra = None
+        # Only the first ':' of a piece separates key and value, so values
+        # can contain ':' (e.g. times).
+        for piece in meta.split(';') if ';' in meta else (meta,):
+            key, _, value = piece.partition(':')
+            key = key.strip()
+            if key == 'id':
+                id_ = value.strip()
+            elif key == 'tags':
+                value = value.strip()
+                tags = tuple(value.split(',')) if value else ()
+            elif key == 'date':
+                date = _parse_date(value.strip()) or None
+            elif key:
+                if extra is None:
+                    extra = {}
+                extra[key] = value.strip()
+        if id_ is None:
+            id_ = _hash(text, scheme)
+        yield Task(id_, text, tags, date, extra)
+
+
+def _iter_lines(content):
+    """
+    Yield the lines of the text content, without their newlines.
+    """
+    find = content.find
+    start = 0
+    end = find('\n')
+    while end >= 0:
+        yield content[start:end]
+        start = end + 1
+        end = find('\n', start)
+    yield content[start:]
+
+
+def _task_from_taskline(taskline, scheme='sha1'):
     """
     Parse a taskline from a tasks file.
 
@@ -437,22 +2914,193 @@ def _task_from_taskline(taskline):
     will be generated automatically upon reading. Thus it is possible to
     edit the taskfile in a plain text editor simply.
 
-    The task returned will be a dictionary such as:
+    Metadata values may themselves contain ':', as only the first ':' of each
+    piece separates the key from the value. If there is no id in the metadata,
+    one is generated from the text in the id scheme `scheme`.
+
+    The task returned will be a Task, behaving as a dictionary such as:
 
         { 'id': <hash id>,
           'text': <summary text>,
            ... other metadata ... }
     """
-    if '|' in taskline:
-        text, _, meta = taskline.rpartition('|')
-        task = {'text': text.strip()}
-        for piece in meta.strip().split(';'):
-            key, value = piece.split(':')
-            task[key.strip()] = value.strip()
-    else:
-        text = taskline.strip()
-        task = {'text': text, 'id': _hash(text)}
-    return task
+    for task in _iter_tasks(taskline.replace('\n', ' '), scheme):
+        return task
+    return Task(_hash('', scheme), '')
+
+
+class _TaskServer():
+    """
+    State of a `tld --serve` process.
+
+    A TaskDict is kept in memory for each list that has been used. Before each
+    command, the list's files are checked, and the TaskDict is read again if
+    they were changed by anything other than this server.
+    """
+    def __init__(self):
+        self.taskdicts = {}
+
+    def handle(self, request):
+        """
+        Run the command described by request and return the response.
+
+        request is a dictionary with the client's 'argv' and 'cwd', and the
+        client's standard input as 'stdin' if it is needed. The response has
+        the 'stdout' of the command, and an 'error' message if it failed.
+
+        If parsing the arguments exits (e.g. for --help or a usage error),
+        the response also has the exit 'status', and what argparse printed
+        as its 'stdout' and 'error'.
+        """
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                args = _parse_args(request['argv'])
+        except SystemExit as err:
+            return {'stdout': stdout.getvalue(), 'error': stderr.getvalue(),
+                    'status': err.code or 0}
+        taskdir = os.path.join(request['cwd'],
+                               os.path.expanduser(args.taskdir))
+        if args.batch and args.batch != '-':
+            args.batch = os.path.join(request['cwd'],
+                                      os.path.expanduser(args.batch))
+        text = ' '.join(args.text).strip()
+        key = (os.path.realpath(taskdir), args.name, args.cache,
+               args.journal, args.fsync, args.id_scheme, args.rotate_done)
+        stdin = io.StringIO(request.get('stdin') or '')
+        try:
+            if args.all_lists:
+                taskdirectory = TaskDirectory(taskdir=taskdir,
+                                              cache=args.cache,
+                                              id_scheme=args.id_scheme)
+                with contextlib.redirect_stdout(stdout):
+                    taskdirectory.print_lists(jobs=args.jobs,
+                                              **_list_options(args))
+                return {'stdout': stdout.getvalue(), 'error': None}
+            with task_lock(taskdir=taskdir, name=args.name,
+                           exclusive=_is_mutation(args, text),
+                           timeout=args.lock_timeout):
+                taskdict = self._taskdict(key)
+                with contextlib.redirect_stdout(stdout):
+                    if args.print_version:
+                        print_version()
+                    else:
+                        _run(taskdict, args, text, stdin=stdin)
+                self.taskdicts[key] = (taskdict, taskdict.file_signatures())
+        # The TaskDict might not match its files after a failed command, so
+        # it is dropped and read again next time.
+        except Exception as err:    # pylint: disable=broad-except
+            self.taskdicts.pop(key, None)
+            return {'stdout': stdout.getvalue(),
+                    'error': "{}: {}".format(type(err).__name__, err)}
+        return {'stdout': stdout.getvalue(), 'error': None}
+
+    def _taskdict(self, key):
+        """
+        Return the in-memory TaskDict for key, reading it if needed.
+        """
+        if key in self.taskdicts:
+            taskdict, signatures = self.taskdicts[key]
+            if signatures == taskdict.file_signatures():
+                return taskdict
+        taskdir, name, cache, journal, fsync, id_scheme, rotate_done = key
+        return TaskDict(taskdir=taskdir, name=name, cache=cache,
+                        journal=journal, fsync=fsync, id_scheme=id_scheme,
+                        rotate_done=rotate_done)
+
+
+def serve(socket_path):
+    """
+    Serve tld commands on the Unix socket at socket_path until interrupted.
+
+    SIGTERM stops the server like an interrupt, so that it cleans up its
+    socket when run in the background.
+    """
+    import signal
+
+    def interrupt(*_):
+        raise KeyboardInterrupt
+
+    server = _make_server(socket_path)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+    return
+
+
+def _make_server(socket_path):
+    """
+    Return a server listening on the Unix socket at socket_path.
+
+    Each connection carries one command: a line of JSON from the client (see
+    `_TaskServer.handle`), answered by a line of JSON. Commands are handled
+    one at a time.
+    """
+    # These are only needed by the server and client, so they are imported
+    # here rather than slowing down every other run of tld.
+    import json
+    import socket
+    import socketserver
+
+    state = _TaskServer()
+
+    class Handler(socketserver.StreamRequestHandler):
+        "Answer a single command."
+        def handle(self):
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = state.handle(request)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+        else:
+            raise IOError("A server is already running on {}.".format(
+                socket_path))
+        finally:
+            probe.close()
+    return socketserver.UnixStreamServer(socket_path, Handler)
+
+
+def _forward(socket_path, argv):
+    """
+    Send a command line to the server on socket_path and print its output.
+
+    Return False, without doing anything, if no server is listening there.
+    """
+    import json
+    import socket
+
+    request = {'argv': argv, 'cwd': os.getcwd()}
+    if '-' in argv and '--batch' in argv:
+        request['stdin'] = sys.stdin.read()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return False
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        stream.flush()
+        response = json.loads(stream.readline().decode('utf-8'))
+    sys.stdout.write(response['stdout'])
+    if 'status' in response:
+        sys.stderr.write(response['error'])
+        sys.exit(response['status'])
+    if response['error']:
+        sys.exit(response['error'])
+    return True
 
 
 def print_version():
@@ -472,15 +3120,32 @@ def print_version():
     return
 
 
-def main(input_args=None):
+def _is_mutation(args, text):
     """
-    Primary entry point. Parse command line and interpret taskdict.
+    Return whether the command line changes the list.
     """
-    args = _build_parser().parse_args(args=input_args)
-    taskdict = TaskDict(taskdir=args.taskdir, name=args.name)
-    text = ' '.join(args.text).strip()
-    if args.print_version:
-        print_version()
+    return bool(args.batch or args.finish or args.remove
+                or args.delete_finished or args.edit or args.compress_done
+                or text)
+
+
+def _run(taskdict, args, text, stdin=None):
+    """
+    Carry out the action given on the command line on taskdict.
+
+    A batch given as '-' is read from stdin, which defaults to sys.stdin.
+    """
+    if args.batch:
+        if args.batch == '-':
+            report = taskdict.run_batch(stdin or sys.stdin,
+                                        tags=args.opttag,
+                                        dated=args.dated)
+        else:
+            with open(args.batch, 'r') as bfile:
+                report = taskdict.run_batch(bfile, tags=args.opttag,
+                                            dated=args.dated)
+        taskdict.write(args.delete_if_empty)
+        _write_lines(report)
     elif args.finish:
         taskdict.finish_task(args.finish)
         taskdict.write(args.delete_if_empty)
@@ -490,6 +3155,8 @@ def main(input_args=None):
     elif args.delete_finished:
         taskdict.delete_finished()
         taskdict.write(args.delete_if_empty)
+    elif args.compress_done:
+        taskdict.compress_done(args.compress_done)
     elif args.edit:
         taskdict.edit_task(args.edit, text, tags=args.opttag)
         taskdict.write(args.delete_if_empty)
@@ -497,13 +3164,155 @@ def main(input_args=None):
         taskdict.add_task(text, tags=args.opttag, dated=args.dated)
         taskdict.write(args.delete_if_empty)
     else:
-        kind = 'tasks' if not args.done else 'done'
-        taskdict.print_list(kind=kind,
-                            quiet=args.quiet,
-                            grep_string=args.grep_string,
-                            showtags=args.showtags,
-                            showdates=args.showdates,
-                            longname=args.longname)
+        taskdict.print_list(**_list_options(args))
+
+
+def _list_options(args):
+    """
+    Return the keyword arguments of `TaskDict.print_list` given on the
+    command line.
+    """
+    return {
+        'kind': 'tasks' if not args.done else 'done',
+        'quiet': args.quiet,
+        'grep_string': args.grep_string,
+        'showtags': args.showtags,
+        'showdates': args.showdates,
+        'longname': args.longname,
+        'regex': args.regex,
+        'match_any': args.match_any,
+        'tag_filter': args.tag_filter,
+        'words': args.words,
+        'sort': args.sort,
+        'limit': args.limit,
+        'offset': args.offset,
+        'output_format': args.output_format,
+        'query': args.query,
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _parser():
+    """
+    Return the command line parser, building it on first use.
+    """
+    return _build_parser()
+
+
+# The value of every option when none is given. This must match the defaults
+# of `_build_parser`.
+_DEFAULT_ARGS = {
+    'text': [], 'edit': '', 'finish': None, 'remove': None,
+    'delete_finished': False, 'batch': None, 'opttag': None, 'dated': False,
+    'longname': False, 'name': 'tasks', 'taskdir': '',
+    'delete_if_empty': False, 'lock_timeout': None, 'cache': False,
+    'journal': False, 'fsync': 'write', 'serve': False, 'socket': '',
+    'all_lists': False, 'jobs': 1, 'done': False, 'quiet': False,
+    'grep_string': None, 'regex': False, 'tag_filter': None, 'words': None,
+    'match_any': False, 'showtags': False, 'showdates': False,
+    'print_version': False, 'timings': False, 'profile': None,
+    'id_scheme': 'sha1', 'rotate_done': False, 'compress_done': None,
+    'sort': 'id', 'limit': None, 'offset': 0, 'output_format': 'human',
+    'query': None,
+}
+
+
+def _parse_args(argv):
+    """
+    Parse the command line argv.
+
+    If there are no options, i.e. tld is asked to list the tasks or to add
+    one, the arguments are filled in directly from `_DEFAULT_ARGS` without
+    building the parser.
+
+    With --regex, each grep term must be a valid regular expression, and an
+    invalid one is reported as a usage error.
+    """
+    if any(arg.startswith('-') for arg in argv):
+        parser = _parser()
+        args = parser.parse_args(args=argv)
+        if args.regex:
+            import re
+            for term in args.grep_string or ():
+                try:
+                    re.compile(term)
+                except re.error as err:
+                    parser.error("invalid regular expression {!r}: {}".format(
+                        term, err))
+        return args
+    import types
+    args = types.SimpleNamespace(**_DEFAULT_ARGS)
+    args.text = list(argv)
+    return args
+
+
+def main(input_args=None):
+    """
+    Primary entry point. Parse command line and interpret taskdict.
+    """
+    argv = sys.argv[1:] if input_args is None else list(input_args)
+    socket_path = os.environ.get('TLD_SOCKET')
+    if socket_path:
+        if '--serve' not in argv and _forward(socket_path, argv):
+            return
+    args = _parse_args(argv)
+    profile = args.profile or os.environ.get('TLD_PROFILE')
+    timings = args.timings or os.environ.get('TLD_TIMINGS', '0') != '0'
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(_main, args, timings)
+        finally:
+            profiler.dump_stats(profile)
+    else:
+        _main(args, timings)
+    return
+
+
+def _main(args, timings=False):
+    """
+    Run tld with the parsed command line args, reporting timings to stderr if
+    timings is True.
+    """
+    global _TIMINGS                 # pylint: disable=global-statement
+    if timings:
+        _TIMINGS = _Timings()
+        try:
+            _act(args)
+        finally:
+            _TIMINGS.report(sys.stderr)
+            _TIMINGS = None
+    else:
+        _act(args)
+    return
+
+
+def _act(args):
+    """
+    Do what the parsed command line args ask for.
+    """
+    if args.print_version:
+        print_version()
+        return
+    if args.serve:
+        serve(args.socket or os.path.join(args.taskdir, '.tld.sock'))
+        return
+    if args.all_lists:
+        taskdirectory = TaskDirectory(taskdir=args.taskdir, cache=args.cache,
+                                      id_scheme=args.id_scheme)
+        taskdirectory.print_lists(jobs=args.jobs, **_list_options(args))
+        return
+    text = ' '.join(args.text).strip()
+    with task_lock(taskdir=args.taskdir, name=args.name,
+                   exclusive=_is_mutation(args, text),
+                   timeout=args.lock_timeout):
+        taskdict = TaskDict(taskdir=args.taskdir, name=args.name,
+                            cache=args.cache, journal=args.journal,
+                            fsync=args.fsync, id_scheme=args.id_scheme,
+                            rotate_done=args.rotate_done)
+        _run(taskdict, args, text)
+    return
 
 
 if __name__ == "__main__":